@@ -0,0 +1,409 @@
+import argparse
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from datetime import datetime, timezone
+
+
+# Load test and benchmark for the MQTT -> SQLite -> dashboard pipeline.
+#
+# The ingest part feeds a synthetic multi-topic publisher through the real
+# ingester (sqlite/ingester.py), either via an in-process stand-in broker
+# (default) or via a running mosquitto (--broker host:port). It measures the
+# ingest throughput, the publish-to-commit latency and dropped messages.
+# --workers N runs the sharded mode (INGEST_WORKERS=N): N worker processes,
+# each receiving its share of the messages as from the shared subscription,
+# and the writer.
+#
+# The dashboard part fills databases of the given sizes and times the
+# queries the dashboard sends to the query service (sqlite/query_service.py),
+# their Arrow encoding, and the transforms and chart building of the page
+# (dashboard/series.py).
+#
+# Results are written as JSON so runs of different versions can be compared:
+#   python3 benchmark/benchmark.py --output results.json
+#   python3 benchmark/benchmark.py --broker localhost:1883 --rate 5000 --sizes 10000,1000000
+#   python3 benchmark/benchmark.py --skip-dashboard --workers 4 --payload binary
+#
+# Needs the packages of both images: paho-mqtt, pandas, pyarrow, altair.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'sqlite'))
+sys.path.insert(0, os.path.join(ROOT, 'dashboard'))
+
+import ingester  # noqa: E402
+import latest  # noqa: E402
+import payloads  # noqa: E402
+import query_service  # noqa: E402
+import rollups  # noqa: E402
+import schema  # noqa: E402
+import series  # noqa: E402
+import topic_stats  # noqa: E402
+
+BENCH_TOPIC = 'bench'
+
+
+# Records when each message was committed, keyed by (topic, sequence number)
+class MeasuredIngester(ingester.Ingester):
+    def __init__(self, conn, *args):
+        super().__init__(conn, *args)
+        self.commit_times = {}
+
+    def write_batch(self, batch, received=None):
+        super().write_batch(batch, received)
+        committed = time.time()
+        for topic, value, _message, _ts in batch:
+            self.commit_times[(topic, value)] = committed
+
+    def maintenance(self):
+        pass
+
+
+# The writer of the sharded mode (--workers > 1)
+class MeasuredShardedIngester(MeasuredIngester, ingester.ShardedIngester):
+    pass
+
+
+# Delivers published messages straight to the ingester's on_message, the way
+# paho's network thread would
+class InProcessBroker:
+    def __init__(self, on_message):
+        self.on_message = on_message
+
+    def publish(self, topic, payload):
+        self.on_message(None, None, types.SimpleNamespace(topic=topic, payload=payload))
+
+
+class MosquittoBroker:
+    def __init__(self, host, port, on_message):
+        import paho.mqtt.client as mqtt
+        self.subscriber = mqtt.Client()
+        self.subscriber.on_message = on_message
+        subscribed = threading.Event()
+        self.subscriber.on_subscribe = lambda *args: subscribed.set()
+        self.subscriber.connect(host, port)
+        self.subscriber.subscribe(f'{BENCH_TOPIC}/#')
+        self.subscriber.loop_start()
+        if not subscribed.wait(10):
+            raise RuntimeError(f'No SUBACK from {host}:{port}')
+        self.publisher = mqtt.Client()
+        self.publisher.connect(host, port)
+        self.publisher.loop_start()
+
+    def publish(self, topic, payload):
+        self.publisher.publish(topic, payload)
+
+    def close(self):
+        self.publisher.loop_stop()
+        self.subscriber.loop_stop()
+
+
+# A message of readings values counting up from seq, stamped with the
+# publish time
+def encode_payload(kind, seq, readings):
+    if kind == 'scalar':
+        return str(seq).encode()
+    now = int(time.time() * 1000)
+    if kind == 'json':
+        return json.dumps([[now, seq + i] for i in range(readings)]).encode()
+    return payloads.BINARY_MAGIC + b''.join(payloads.BINARY_RECORD.pack(now, seq + i) for i in range(readings))
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(p / 100 * len(values))) - 1)]
+
+
+# Publishes the benchmark's messages; returns the publish time of each, keyed
+# by (topic, sequence number), and when publishing started and ended.
+# Payloads are per-topic sequence numbers, so every row maps back to the
+# moment it was published. With --readings N each message carries N readings
+# (see sqlite/payloads.py); the first one identifies it. share=(index, count)
+# publishes only every count-th message, starting at index.
+def publish_all(args, broker, share=(0, 1)):
+    topics = [f'{BENCH_TOPIC}/line{i // 10}/sensor{i}' for i in range(args.topics)]
+    readings = args.readings if args.payload != 'scalar' else 1
+    sent = {}
+    total = int(args.rate * args.duration) if args.rate else args.messages
+    interval = 1 / args.rate if args.rate else 0
+    publish_start = time.time()
+    for n in range(share[0], total, share[1]):
+        topic = topics[n % len(topics)]
+        seq = float(n // len(topics) * readings)
+        if interval:
+            # Pace against the schedule, not the previous message
+            delay = publish_start + n * interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        sent[(topic, seq)] = time.time()
+        broker.publish(topic, encode_payload(args.payload, seq, readings))
+    return sent, publish_start, time.time()
+
+
+# One worker of the sharded mode (see ingester.Worker) with its own copy of
+# the publisher: like the broker with the workers' shared subscription, it
+# hands the worker every workers-th message. Reports their publish times.
+def run_shard(index, args, workdir, chunks, go, results):
+    ingester.SPOOL_PATH = os.path.join(workdir, 'spool.jsonl')
+    worker = ingester.Worker(index, chunks)
+    threading.Thread(target=worker.forward, daemon=True).start()
+    go.wait()
+    results.put(publish_all(args, InProcessBroker(worker.on_message), (index, args.workers)))
+    # Keep handing over until the writer stops the process
+    threading.Event().wait()
+
+
+def run_ingest(args, workdir):
+    db_path = os.path.join(workdir, 'ingest.db')
+    started = threading.Event()
+    holder = {}
+
+    workers = []
+    if args.workers > 1:
+        # Started before the writer opens the database, as in ingester.main
+        chunks = multiprocessing.Queue(maxsize=max(1, ingester.QUEUE_SIZE // ingester.BATCH_SIZE))
+        go = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=run_shard, args=(index, args, workdir, chunks, go, results),
+                                           name=f'worker-{index}', daemon=True)
+                   for index in range(args.workers)]
+        for worker in workers:
+            worker.start()
+
+    # The ingester's connection has to be opened in the thread that uses it
+    def writer():
+        conn = ingester.open_database(db_path)
+        holder['ingester'] = MeasuredShardedIngester(conn, chunks, workers) if workers else MeasuredIngester(conn)
+        started.set()
+        holder['ingester'].run()
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    started.wait()
+    measured = holder['ingester']
+
+    broker = None
+    if workers:
+        go.set()
+        sent = {}
+        shards = [results.get() for _ in workers]
+        for shard_sent, _start, _end in shards:
+            sent.update(shard_sent)
+        publish_start = min(shard[1] for shard in shards)
+        publish_end = max(shard[2] for shard in shards)
+    else:
+        if args.broker:
+            host, _, port = args.broker.partition(':')
+            broker = MosquittoBroker(host, int(port or 1883), measured.on_message)
+        else:
+            broker = InProcessBroker(measured.on_message)
+        sent, publish_start, publish_end = publish_all(args, broker)
+    total = len(sent)
+    readings = args.readings if args.payload != 'scalar' else 1
+
+    # Wait for the pipeline to drain
+    deadline = time.time() + args.drain_timeout
+    while measured.stored < total * readings and time.time() < deadline:
+        time.sleep(0.05)
+    measured.stop()
+    thread.join(5)
+    for worker in workers:
+        worker.terminate()
+    if args.broker:
+        broker.close()
+
+    latencies = [(measured.commit_times[key] - t) * 1000 for key, t in sent.items() if key in measured.commit_times]
+    last_commit = max(measured.commit_times.values()) if measured.commit_times else publish_end
+    return {
+        'broker': args.broker or 'in-process',
+        'workers': args.workers,
+        'topics': args.topics,
+        'target_rate': args.rate,
+        'payload': args.payload,
+        'readings_per_message': readings,
+        'published': total,
+        'stored': measured.stored,
+        'dropped': total - len(latencies),
+        'batches': measured.batches,
+        'publish_rate': total / max(publish_end - publish_start, 1e-9),
+        'ingest_rate': measured.stored / max(last_commit - publish_start, 1e-9),
+        'latency_ms': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies) if latencies else None,
+        },
+    }
+
+
+# Fills a database with rows readings spread over the last 30 days
+def build_database(path, rows, topics):
+    conn = sqlite3.connect(path)
+    schema.ensure_schema(conn)
+    now = int(time.time() * 1000)
+    step = max(1, 30 * 24 * 60 * 60 * 1000 // rows)
+    chunk = 100000
+    with conn:
+        conn.executemany('INSERT INTO topics (id, name) VALUES (?, ?)', ((i + 1, f'T{i}') for i in range(topics)))
+    for offset in range(0, rows, chunk):
+        with conn:
+            conn.executemany('INSERT INTO temp (topic_id, value, message, ts) VALUES (?, ?, NULL, ?)',
+                             ((i % topics + 1, 55 + 5 * math.sin(i / 5000), now - (rows - i) * step)
+                              for i in range(offset, min(rows, offset + chunk))))
+    with conn:
+        rollups.rebuild_rollups(conn)
+        latest.rebuild_latest(conn)
+        # The totals first: the windows are only written for topics with one
+        topic_stats.rebuild_totals(conn)
+        stats = topic_stats.TopicStats()
+        stats.restore(conn)
+        stats.store(conn)
+    return conn
+
+
+# Median wall time (ms) of repeat calls, and the last result
+def timed(repeat, function, *args):
+    times = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(*args)
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times), result
+
+
+def run_dashboard(args, workdir, rows):
+    path = os.path.join(workdir, f'dashboard-{rows}.db')
+    started = time.perf_counter()
+    conn = build_database(path, rows, args.topics)
+    build_seconds = time.perf_counter() - started
+
+    # The service's queries without the HTTP round trip, with the parameters
+    # the dashboard sends (query strings parse to lists of strings)
+    queries = query_service.Queries(path, os.path.join(workdir, 'archive'))
+
+    def params(**values):
+        return {name: [str(item) for item in value] if isinstance(value, list) else [str(value)] for name, value in values.items()}
+
+    version = queries.version()
+    max_id, first_id = version['max_id'], version['first_id']
+    timings = {}
+
+    timings['query_topics'], topics = timed(args.repeat, queries.topics)
+    timings['query_window'], (window_rows, _) = timed(args.repeat, queries.series, params(after=0, limit=series.WINDOW_ROWS))
+    timings['query_delta_100'], (delta_rows, _) = timed(args.repeat, queries.series, params(after=max_id - 100, limit=series.WINDOW_ROWS))
+    # The window of a single sensor, as with a topic filter set
+    one_topic = params(after=0, limit=series.WINDOW_ROWS, topic_id=series.match_topics(topics, 'T1')[:1])
+    timings['query_window_one_topic'], _ = timed(args.repeat, queries.series, one_topic)
+    timings['query_latest'], _ = timed(args.repeat, queries.latest, {})
+    timings['query_stats'], _ = timed(args.repeat, queries.stats, {})
+    timings['query_alarms'], alarm_state = timed(args.repeat, queries.alarms)
+    timings['query_rollup_24h'], (minute_rows, _) = timed(args.repeat, queries.series, params(resolution='1m', span=series.TIME_SPANS['24 hours']))
+    timings['query_rollup_7d'], (hour_rows, _) = timed(args.repeat, queries.series, params(resolution='1h', span=series.TIME_SPANS['7 days']))
+    # What a response cache miss adds on top of the query
+    timings['encode_window_arrow'], _ = timed(args.repeat, query_service.encode, window_rows, max_id, 0, 'arrow')
+
+    timings['transform_window'], window = timed(args.repeat, series.append_rows, None, window_rows, first_id, topics)
+    timings['transform_delta_100'], _ = timed(args.repeat, series.append_rows, window, delta_rows, first_id, topics)
+    span_start = int(window['ts'].iloc[0])
+    timings['transform_raw_series'], raw = timed(args.repeat, series.raw_series, window, span_start)
+    timings['transform_rollup_24h'], minute_series = timed(args.repeat, series.rollup_series, minute_rows, topics)
+    timings['transform_rollup_7d'], hour_series = timed(args.repeat, series.rollup_series, hour_rows, topics)
+
+    rules = alarm_state['rules']
+    timings['render_raw'], _ = timed(args.repeat, series.chart_spec, raw, 'raw', rules)
+    timings['render_rollup_24h'], _ = timed(args.repeat, series.chart_spec, minute_series, '1m', rules)
+    timings['render_rollup_7d'], _ = timed(args.repeat, series.chart_spec, hour_series, '1h', rules)
+
+    conn.close()
+    if not args.keep:
+        os.remove(path)
+    return {
+        'rows': rows,
+        'topics': args.topics,
+        'build_seconds': build_seconds,
+        'points': {'raw': len(raw), 'rollup_24h': len(minute_series), 'rollup_7d': len(hour_series)},
+        'timings_ms': timings,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the MQTT -> SQLite -> dashboard pipeline')
+    parser.add_argument('--broker', help='host:port of a running mosquitto (default: in-process stand-in)')
+    parser.add_argument('--topics', type=int, default=50, help='number of synthetic sensors')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second, 0 = as fast as possible')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to publish for when --rate is set')
+    parser.add_argument('--messages', type=int, default=200000, help='messages to publish when --rate is 0')
+    parser.add_argument('--payload', choices=('scalar', 'json', 'binary'), default='scalar', help='payload format of the published messages')
+    parser.add_argument('--readings', type=int, default=10, help='readings per message with --payload json or binary')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='receiving processes as with INGEST_WORKERS; more than one needs the in-process stand-in')
+    parser.add_argument('--drain-timeout', type=float, default=30, help='seconds to wait for the ingester to catch up')
+    parser.add_argument('--sizes', default='10000,1000000,10000000', help='database sizes (rows) for the dashboard part')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per dashboard step, the median is reported')
+    parser.add_argument('--skip-ingest', action='store_true')
+    parser.add_argument('--skip-dashboard', action='store_true')
+    parser.add_argument('--workdir', help='directory for the benchmark databases (default: a temporary one)')
+    parser.add_argument('--keep', action='store_true', help='keep the generated databases')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    args = parser.parse_args()
+    if args.workers > 1 and args.broker:
+        parser.error('--workers needs the in-process stand-in broker')
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='e1-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'started': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'batch_size': ingester.BATCH_SIZE,
+            'batch_interval': ingester.BATCH_INTERVAL,
+        },
+    }
+    if not args.skip_ingest:
+        # The ingester reports on stdout, which may be carrying the JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            results['ingest'] = run_ingest(args, workdir)
+        print(f"ingest ({args.workers} workers): {results['ingest']['ingest_rate']:.0f} msg/s, "
+              f"p99 {results['ingest']['latency_ms']['p99']} ms, dropped {results['ingest']['dropped']}", file=sys.stderr)
+    if not args.skip_dashboard:
+        results['dashboard'] = []
+        for rows in (int(size) for size in args.sizes.split(',')):
+            result = run_dashboard(args, workdir, rows)
+            results['dashboard'].append(result)
+            print(f"dashboard {rows} rows: " + ', '.join(f'{k} {v:.1f} ms' for k, v in result['timings_ms'].items()), file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,35 +2,53 @@ import streamlit as st
 import pandas as pd
 import time
 import os
-import matplotlib.pyplot as plt
-from sqlalchemy import text
+import types
+import metrics
+from query_client import QueryClient
+from series import TIME_SPANS, health_table
+from snapshot import Refresher
 
-# Get database path from environment variable or use default
-DB_PATH = os.environ.get('DB_PATH', '/sqlite/data/temperatur.db')
+# Port of the Prometheus /metrics endpoint, 0 to disable
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9101'))
 
-# Set up database connection
-conn = st.connection('sqlite_db', type='sql', url=f'sqlite:///{DB_PATH}')
+# How often (seconds) the query service is asked for new data
+REFRESH_POLL = float(os.environ.get('REFRESH_POLL', '1'))
 
-# Function to update graph data
-def update_graph():
-    try:
-        # Query data from the temp table - increased limit to 10000
-        query = 'SELECT id, topic, message, timestamp FROM temp ORDER BY timestamp DESC LIMIT 10000'
-        data = conn.query(query)
-        if not data.empty:
-            # Convert to dataframe for visualization
-            df = pd.DataFrame(data)
-            # Convert timestamp to datetime if needed
-            df['timestamp'] = pd.to_datetime(df['timestamp'])
-            # Convert message to numeric values where possible
-            df['numeric_message'] = pd.to_numeric(df['message'], errors='coerce')
-            return df
-        else:
-            st.warning("No data found in the database.")
-            return pd.DataFrame()
-    except Exception as e:
-        st.error(f"Error querying database: {e}")
-        return pd.DataFrame()
+# Timings of the page's hot paths. Created once per dashboard process, since
+# the script itself runs again on every rerun.
+@st.cache_resource
+def dashboard_metrics():
+    if METRICS_PORT:
+        metrics.start_server(METRICS_PORT)
+    return types.SimpleNamespace(
+        reruns=metrics.Counter('dashboard_reruns_total', 'Full page runs'),
+        update_graph=metrics.Histogram('dashboard_update_graph_seconds', 'Time to refresh the shared data snapshots'),
+        alarm=metrics.Histogram('dashboard_alarm_seconds', 'Time to evaluate and show the alarm status'),
+        chart=metrics.Histogram('dashboard_chart_seconds', 'Time to load the chart series and build the chart'),
+    )
+
+timings = dashboard_metrics()
+timings.reruns.inc()
+
+# All sessions of the dashboard process read the same snapshots, kept current
+# by one background thread (see snapshot.py), which reads from the query
+# service (QUERY_URL). A rerun sends no requests itself; the only per-session
+# work is laying out the page.
+@st.cache_resource
+def shared_refresher():
+    return Refresher(QueryClient(), REFRESH_POLL, timings.update_graph)
+
+try:
+    refresher = shared_refresher()
+except Exception as e:
+    # E.g. the query service or the database is not up yet; retried next run
+    st.error(f"Error querying database: {e}")
+    st.stop()
+
+# "T1: 58.3°C (12 s ago)"
+def reading_label(row):
+    age = max(0, int(time.time() - row['ts'] / 1000))
+    return f"{row['topic']}: {row['numeric_message']:.1f}°C ({age} s ago)"
 
 # Topic filter with improved styling
 st.markdown("""
@@ -75,128 +93,88 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# Initialize topic_filter from session state or empty string
+# Initialize topic_filter from session state or empty string. The filter
+# input is keyed on it, so an edited filter is already in place when the
+# queries run, not one rerun later.
 if 'topic_filter' not in st.session_state:
     st.session_state.topic_filter = ""
 
-# Main update loop
-df = update_graph()
+# Main update loop. The topic filter is matched against the topic names and
+# handed to the queries as ids, so rows of other sensors are never read.
+try:
+    snapshot = refresher.snapshot(st.session_state.topic_filter)
+except Exception as e:
+    st.error(f"Error querying database: {e}")
+    st.stop()
+if refresher.error:
+    st.error(f"Error querying database: {refresher.error}")
+# The snapshot shown, so the watcher below knows when there is a newer one
+st.session_state.snapshot = snapshot
+df = snapshot.window if snapshot.window is not None else pd.DataFrame()
+if snapshot.window is None and not st.session_state.topic_filter:
+    st.warning("No data found in the database.")
 
 if not df.empty:
-    # Apply topic filter if specified
-    if st.session_state.topic_filter:
-        filtered_df = df[df['topic'].str.contains(st.session_state.topic_filter, case=False)]
+    # Alarm status as the ingester's alarm engine has it (see
+    # sqlite/alarms.py): each rule's last transition, and the engine's limits,
+    # so the banner agrees with the stored events and the published alarms
+    alarm_started = time.perf_counter()
+    latest_temps = snapshot.latest.sort_values('numeric_message')
+    limit = snapshot.alarms['rules']['limit']
+    raised = {rule: event for rule, event in snapshot.alarms['state'].items() if event is not None and event['state'] == 'raised'}
+    temp_readings = " | ".join([reading_label(row) for _, row in latest_temps.iterrows()])
+
+    if 'critical' in raised:
+        # Critical alarm: no sensor below the limit
+        st.markdown(f'<div class="alarm-box"><h4 style="color: #d32f2f; margin: 0;">CRITICAL TEMPERATURE ALERT</h4><p style="margin: 5px 0; font-size: 14px;"><strong>TEMPERATURE ALARM: {raised["critical"]["message"]}</strong></p><p style="margin: 5px 0; font-size: 14px;"><strong>Current temperatures:</strong></p>', unsafe_allow_html=True)
+
+        for _, row in latest_temps.iterrows():
+            color = "#d32f2f" if row['numeric_message'] >= limit else "#2e7d32"
+            st.markdown(f"<p style='margin: 2px 0; color: {color}; font-size: 12px;'><strong>{reading_label(row)}</strong></p>", unsafe_allow_html=True)
+
+        st.markdown("</div>", unsafe_allow_html=True)
+    elif 'band' in raised:
+        # Warning: no sensor in the target band (but one is below the limit)
+        st.markdown(f'<div class="warning-box"><strong>Warning:</strong> {raised["band"]["message"]}</div>', unsafe_allow_html=True)
+        if temp_readings:
+            st.markdown(f'<div style="font-size: 12px; padding: 5px; background-color: #f5f5f5; border-radius: 5px; margin: 5px 0;">Current: {temp_readings}</div>', unsafe_allow_html=True)
     else:
-        filtered_df = df
-    
-    # Temperature alarm system - check latest values for each topic (moved before graph)
-    numeric_df = filtered_df.dropna(subset=['numeric_message'])
-    if not numeric_df.empty:
-        # Get the latest temperature reading for each topic
-        latest_temps = numeric_df.groupby('topic')['numeric_message'].last().reset_index()
-        latest_temps = latest_temps.sort_values('numeric_message')
-        
-        # Check alarm conditions
-        alarm_triggered = False
-        warning_triggered = False
-        alarm_message = ""
-        warning_message = ""
-        
-        if len(latest_temps) >= 1:
-            lowest_temp = latest_temps.iloc[0]['numeric_message']
-            lowest_topic = latest_temps.iloc[0]['topic']
-            highest_temp = latest_temps.iloc[-1]['numeric_message']
-            highest_topic = latest_temps.iloc[-1]['topic']
-            
-            # Check if lowest temperature is 55°C or above (critical alarm)
-            if lowest_temp >= 55:
-                alarm_triggered = True
-                alarm_message = f"TEMPERATURE ALARM: Lowest temperature ({lowest_topic}: {lowest_temp:.1f}°C) is not below 55°C limit!"
-            
-            # Check if no temperature is in 59-60°C range (warning)
-            temp_in_range = any(59 <= temp <= 60 for temp in latest_temps['numeric_message'])
-            if not temp_in_range:
-                warning_triggered = True
-                if highest_temp < 59:
-                    warning_message = f"No temperature in optimal 59-60°C range. Highest: {highest_topic}: {highest_temp:.1f}°C"
-                else:
-                    warning_message = f"No temperature in optimal 59-60°C range. Temperatures above 60°C detected."
-        
-        # Display status based on conditions
-        if alarm_triggered:
-            # Critical alarm: lowest temp >= 55°C
-            st.markdown(f'<div class="alarm-box"><h4 style="color: #d32f2f; margin: 0;">CRITICAL TEMPERATURE ALERT</h4><p style="margin: 5px 0; font-size: 14px;"><strong>{alarm_message}</strong></p><p style="margin: 5px 0; font-size: 14px;"><strong>Current temperatures:</strong></p>', unsafe_allow_html=True)
-            
-            for _, row in latest_temps.iterrows():
-                color = "#d32f2f" if row['numeric_message'] >= 55 else "#2e7d32"
-                st.markdown(f"<p style='margin: 2px 0; color: {color}; font-size: 12px;'><strong>{row['topic']}: {row['numeric_message']:.1f}°C</strong></p>", unsafe_allow_html=True)
-            
-            st.markdown("</div>", unsafe_allow_html=True)
-        elif warning_triggered:
-            # Warning: no temp in 59-60°C range (but lowest temp is <55°C)
-            st.markdown(f'<div class="warning-box"><strong>Warning:</strong> {warning_message}</div>', unsafe_allow_html=True)
-            temp_readings = " | ".join([f"{row['topic']}: {row['numeric_message']:.1f}°C" for _, row in latest_temps.iterrows()])
+        # OK status only while neither rule is raised
+        st.markdown('<div class="success-box"><strong>Status:</strong> Temperature levels OK</div>', unsafe_allow_html=True)
+        if temp_readings:
             st.markdown(f'<div style="font-size: 12px; padding: 5px; background-color: #f5f5f5; border-radius: 5px; margin: 5px 0;">Current: {temp_readings}</div>', unsafe_allow_html=True)
-        else:
-            # OK status only when BOTH conditions are met:
-            # 1. Lowest temp is under 55°C AND
-            # 2. At least one temp is in 59-60°C range
-            if len(latest_temps) >= 1 and lowest_temp < 55 and temp_in_range:
-                st.markdown('<div class="success-box"><strong>Status:</strong> Temperature levels OK</div>', unsafe_allow_html=True)
-                temp_readings = " | ".join([f"{row['topic']}: {row['numeric_message']:.1f}°C" for _, row in latest_temps.iterrows()])
-                st.markdown(f'<div style="font-size: 12px; padding: 5px; background-color: #f5f5f5; border-radius: 5px; margin: 5px 0;">Current: {temp_readings}</div>', unsafe_allow_html=True)
+
+    # Transitions recorded by the ingester's alarm engine, which evaluates the
+    # rules for every reading whether or not the page is open
+    if not snapshot.events.empty:
+        with st.expander("Alarm events"):
+            st.dataframe(snapshot.events, use_container_width=True, hide_index=True)
+    timings.alarm.observe(time.perf_counter() - alarm_started)
 
     # Display numerical messages in a chart - MAIN GRAPH (now full width)
+    chart_started = time.perf_counter()
     try:
-        numeric_df = filtered_df.dropna(subset=['numeric_message'])
-        
-        if not numeric_df.empty:
+        span_label = st.selectbox("Time span", list(TIME_SPANS), index=1)
+        resolution, spec = snapshot.chart(span_label)
+
+        if spec is not None:
             st.subheader("Message Values Over Time")
+            resolution_label = {'raw': 'raw readings', '1m': '1-minute averages', '1h': '1-hour averages'}[resolution]
+            st.caption(f"Showing {resolution_label} for the last {span_label}")
             
-            # Use Matplotlib for better control over line rendering
-            fig, ax = plt.subplots(figsize=(30, 20))  # Much larger graph size
-            
-            # Get unique topics
-            topics = numeric_df['topic'].unique()
-            
-            # Plot each topic as a separate line
-            for topic in topics:
-                topic_data = numeric_df[numeric_df['topic'] == topic]
-                # Sort by timestamp to ensure proper line connections
-                topic_data = topic_data.sort_values('timestamp')
-                ax.plot(topic_data['timestamp'], topic_data['numeric_message'], 
-                       marker='o', label=topic, linewidth=6, markersize=6)
-            
-            # Add horizontal lines for temperature thresholds
-            ax.axhline(y=55, color='red', linestyle='--', alpha=0.7, label='55°C Limit')
-            ax.axhline(y=59, color='orange', linestyle='--', alpha=0.7, label='59°C Target Min')
-            ax.axhline(y=60, color='green', linestyle='--', alpha=0.7, label='60°C Target Max')
-            
-            ax.set_xlabel('Time', fontsize=48)  # Increased from 36 to 48
-            ax.set_ylabel('Temperature (°C)', fontsize=48)  # Increased from 36 to 48
-            ax.legend(fontsize=32)  # Increased from 22 to 32
-            ax.grid(True, alpha=0.3)
-            
-            # Improve layout with larger tick font
-            plt.xticks(rotation=45, fontsize=42)  # Increased from 36 to 42
-            plt.yticks(fontsize=42)  # Increased from 36 to 42
-            plt.tight_layout()
-            
-            # Display the plot
-            st.pyplot(fig)
+            st.vega_lite_chart(spec=spec, use_container_width=True)
             
         else:
             st.info("No numeric messages found for charting.")
     except Exception as e:
         st.error(f"Could not display chart: {e}")
         st.info("Messages may not be numerical")
+    timings.chart.observe(time.perf_counter() - chart_started)
     
     # Filter by topic input - positioned between graph and recent messages
     col_filter, col_spacer = st.columns([2, 2])
     with col_filter:
-        st.session_state.topic_filter = st.text_input("Filter by topic", 
-                                                      value=st.session_state.topic_filter,
-                                                      placeholder="Enter topic name...")
+        st.text_input("Filter by topic", key='topic_filter', placeholder="Enter topic name...")
     
     # Create layout for bottom section - Recent Messages and Statistics side by side
     col_bottom1, col_bottom2 = st.columns([3, 1])
@@ -204,41 +182,63 @@ if not df.empty:
     with col_bottom1:
         # Display the most recent messages
         st.subheader("Recent Messages")
-        st.dataframe(filtered_df[['topic', 'message', 'timestamp']].head(5), 
+        st.dataframe(df[['topic', 'message', 'timestamp']].tail(5).iloc[::-1], 
                     use_container_width=True)
     
+    # Kept up to date by the ingester (see sqlite/topic_stats.py), so none of
+    # this scans rows
+    stats = snapshot.stats
     with col_bottom2:
         st.subheader("Statistics")
-        st.metric("Total Messages", len(df))
+        # Every numeric reading stored for the selected topics, archived ones included
+        st.metric("Total Readings", f"{int(stats.loc[stats['span'] == 'all', 'count'].sum()):,}")
+        st.metric("Sensors", stats['topic_id'].nunique())
+
+    if not stats.empty:
+        with st.expander("Sensor health", expanded=True):
+            st.dataframe(health_table(stats, int(time.time() * 1000)), use_container_width=True, hide_index=True)
+
+    # The raw rows of the filtered topics, archived ones included, streamed
+    # by the query service straight to the browser
+    with st.expander("Export data"):
+        col_span, col_format = st.columns(2)
+        with col_span:
+            export_span = st.selectbox("Period", list(TIME_SPANS) + ["All data"], index=3, key='export_span')
+        with col_format:
+            export_format = st.selectbox("Format", ["csv", "parquet"], key='export_format')
+        st.link_button("Download", refresher.client.export_url(
+            format=export_format, span=TIME_SPANS.get(export_span), topic_id=refresher.topic_param(snapshot.topic_ids)))
+elif st.session_state.topic_filter:
+    # Keep the filter reachable when it matches no messages
+    st.info(f"No messages from topics matching '{st.session_state.topic_filter}'.")
+    st.text_input("Filter by topic", key='topic_filter', placeholder="Enter topic name...")
 
 # Add refresh and reset buttons
 col_btn1, col_btn2 = st.columns(2)
 
 with col_btn1:
     if st.button("Refresh Data"):
-        st.cache_data.clear()
+        refresher.refresh()
         st.rerun()
 
 with col_btn2:
     if st.button("Reset Database", type="secondary"):
         try:
-            # Execute DELETE query using the underlying connection with text wrapper
-            with conn._instance.connect() as connection:
-                connection.execute(text("DELETE FROM temp"))
-                connection.commit()
-            st.success("Database reset successfully! All data has been cleared.")
-            st.cache_data.clear()
+            # The ingester owns the database writes; it drops the archived
+            # partitions and empties the tables between two of its batches
+            refresher.client.reset()
+            st.success("Database reset requested. All data will be cleared within a few seconds.")
             time.sleep(1)  # Brief pause to show the success message
             st.rerun()
         except Exception as e:
             st.error(f"Error resetting database: {e}")
 
-# Implement auto-refresh with fixed 10 second interval
-if "last_refresh" not in st.session_state:
-    st.session_state.last_refresh = time.time()
+# Refresh when the data changes instead of on a fixed timer. Only this small
+# fragment runs every REFRESH_POLL seconds; the page is rebuilt when the
+# refresher has published newer snapshots, so idle periods cost nothing.
+@st.fragment(run_every=REFRESH_POLL)
+def watch_for_new_data():
+    if not refresher.is_current(st.session_state.snapshot):
+        st.rerun()
 
-# Check if it's time to refresh (fixed 10 second refresh rate)
-if time.time() > st.session_state.last_refresh + 10:
-    st.session_state.last_refresh = time.time()
-    st.cache_data.clear()
-    st.rerun()
+watch_for_new_data()
@@ -0,0 +1,64 @@
+import json
+import os
+import urllib.request
+from urllib.parse import urlencode
+
+import pyarrow as pa
+
+# HTTP client for the query service (sqlite/query_service.py). The dashboard
+# reads everything through it and never opens temperatur.db itself.
+QUERY_URL = os.environ.get('QUERY_URL', 'http://localhost:8080')
+
+# The query service as the user's browser reaches it, for download links
+EXPORT_URL = os.environ.get('EXPORT_URL', 'http://localhost:8080')
+
+# Sent with reset requests; the query service's RESET_TOKEN
+RESET_TOKEN = os.environ.get('RESET_TOKEN', '')
+
+# Seconds to wait for an answer
+QUERY_TIMEOUT = float(os.environ.get('QUERY_TIMEOUT', '10'))
+
+
+class QueryClient:
+    def __init__(self, url=QUERY_URL, timeout=QUERY_TIMEOUT):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    # Parameters with a value of None are left out; a list is sent as a
+    # repeated parameter, an empty list as a single empty one (topic_id= for
+    # "no topics", unlike no topic_id at all for "all topics")
+    @staticmethod
+    def url_for(base, path, params=None):
+        query = []
+        for name, value in (params or {}).items():
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple)):
+                query += [(name, item) for item in value] or [(name, '')]
+            else:
+                query.append((name, value))
+        return f'{base}{path}?{urlencode(query)}' if query else f'{base}{path}'
+
+    def request(self, path, params=None, method='GET', headers=None):
+        request = urllib.request.Request(self.url_for(self.url, path, params), method=method, headers=headers or {})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return response.read(), response.headers
+
+    def get_json(self, path, **params):
+        body, _ = self.request(path, params)
+        return json.loads(body)
+
+    # Returns (frame, cursor); the cursor is None when the endpoint has none
+    def get_frame(self, path, **params):
+        body, headers = self.request(path, dict(params, format='arrow'))
+        frame = pa.ipc.open_stream(body).read_all().to_pandas()
+        cursor = headers.get('X-Cursor')
+        return frame, int(cursor) if cursor is not None else None
+
+    # Asks the ingester to clear all data
+    def reset(self):
+        self.request('/reset', method='POST', headers={'X-Reset-Token': RESET_TOKEN})
+
+    # Link to a CSV or Parquet download of raw rows (see sqlite/export.py)
+    def export_url(self, **params):
+        return self.url_for(EXPORT_URL.rstrip('/'), '/export', params)
@@ -0,0 +1,187 @@
+import pandas as pd
+import numpy as np
+import altair as alt
+
+# Data shaping and chart building for dashboard.py. Kept free of Streamlit so
+# the benchmark (benchmark/benchmark.py) can time exactly what the page runs.
+
+# The series handed to the chart are already bounded by the downsampling and
+# rollups; Altair's default 5000-row guard would reject a few dozen topics
+alt.data_transformers.disable_max_rows()
+
+# Number of newest rows kept in the working window
+WINDOW_ROWS = 10000
+
+# Chart time spans in milliseconds
+TIME_SPANS = {
+    '15 minutes': 15 * 60 * 1000,
+    '1 hour': 60 * 60 * 1000,
+    '6 hours': 6 * 60 * 60 * 1000,
+    '24 hours': 24 * 60 * 60 * 1000,
+    '7 days': 7 * 24 * 60 * 60 * 1000,
+    '30 days': 30 * 24 * 60 * 60 * 1000,
+}
+
+# Longest span drawn from raw rows / from the 1-minute rollups. Longer spans
+# use the 1-hour rollups, so a chart never needs more than a few thousand
+# points per topic (30 days = 720 hourly buckets).
+RAW_MAX_SPAN = 60 * 60 * 1000
+MINUTE_MAX_SPAN = 2 * 24 * 60 * 60 * 1000
+
+# Raw series are downsampled to this many points per topic
+MAX_POINTS = 1000
+
+# Temperature thresholds drawn across the chart, from the alarm engine's
+# rules (the query service's /alarms)
+def threshold_lines(rules):
+    return pd.DataFrame({
+        'value': [rules['limit'], rules['band_min'], rules['band_max']],
+        'label': [f"{rules['limit']:g}°C Limit", f"{rules['band_min']:g}°C Target Min", f"{rules['band_max']:g}°C Target Max"],
+        'color': ['red', 'orange', 'green'],
+    })
+
+# Resolves the topic filter against the registry - a few dozen names, not the
+# rows. Returns the ids of the topics whose name contains pattern, or None
+# when there is no filter.
+def match_topics(topics, pattern):
+    if not pattern:
+        return None
+    return topics.loc[topics['name'].str.contains(pattern, case=False, regex=False), 'id'].tolist()
+
+# Topic ids as a categorical of topic names; every row of a topic shares one
+# string, and the categories follow the registry order
+def topic_categories(topic_ids, topics):
+    codes = pd.Index(topics['id']).get_indexer(topic_ids)
+    return pd.Categorical.from_codes(codes, categories=topics['name'])
+
+# Turn freshly queried rows into the frame layout used by the page
+def prepare_rows(data, topics):
+    df = pd.DataFrame(data)
+    df['topic'] = topic_categories(df['topic_id'], topics)
+    # ts is milliseconds since the epoch (UTC)
+    df['timestamp'] = pd.to_datetime(df['ts'], unit='ms')
+    # value is already numeric; message is only set for non-numeric payloads
+    df['numeric_message'] = df['value']
+    df['message'] = df['message'].fillna(df['value'].astype(str))
+    return df
+
+# Adds new rows (the query service's /series?after=..., oldest first) to the
+# window (oldest row first) and drops rows below first_id (deleted from the
+# table) or beyond the newest WINDOW_ROWS by time. topics is the registry,
+# read after the rows so it knows all their topics.
+def append_rows(window, data, first_id, topics):
+    if window is not None and first_id > window['id'].min():
+        window = window[window['id'] >= first_id]
+    if len(data) == 0:
+        return window
+    new_rows = prepare_rows(data, topics)
+    if window is None or window.empty:
+        window = new_rows
+    else:
+        # Same categories on both sides, or concat falls back to strings
+        window = window.assign(topic=window['topic'].cat.set_categories(new_rows['topic'].cat.categories))
+        older = new_rows['ts'].iloc[0] < window['ts'].iloc[-1]
+        window = pd.concat([window, new_rows], ignore_index=True)
+        # Backfilled rows can be older than rows already in the window
+        if older:
+            window = window.sort_values(['ts', 'id'], kind='stable')
+    # Drop the rows that fell out of the window
+    if len(window) > WINDOW_ROWS:
+        window = window.iloc[-WINDOW_ROWS:]
+    return window.reset_index(drop=True)
+
+# Largest-Triangle-Three-Buckets downsampling. Returns the indices of the
+# points to keep; peaks and dips survive, unlike with plain decimation.
+def lttb(x, y, threshold):
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    every = (n - 2) / (threshold - 2)
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third corner of the triangle
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        # Pick the point of this bucket spanning the largest triangle
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        keep[i + 1] = a
+    return keep
+
+# Pick raw rows, 1-minute or 1-hour rollups for a span starting at start
+# (epoch ms). Raw rows come from the in-memory window, so they are only used
+# while the window reaches back far enough.
+def choose_resolution(window, span, start):
+    if span <= RAW_MAX_SPAN and (len(window) < WINDOW_ROWS or window['ts'].iloc[0] <= start):
+        return 'raw'
+    if span <= MINUTE_MAX_SPAN:
+        return '1m'
+    return '1h'
+
+# Chart series from the window: topic, ts (epoch ms) and value, downsampled
+# per topic with LTTB
+def raw_series(window, start):
+    rows = window[(window['ts'] >= start) & window['numeric_message'].notna()]
+    parts = []
+    for _, topic_rows in rows.groupby('topic', sort=False, observed=True):
+        keep = lttb(topic_rows['ts'].to_numpy(dtype=float), topic_rows['numeric_message'].to_numpy(), MAX_POINTS)
+        parts.append(topic_rows.iloc[keep])
+    series = pd.concat(parts) if parts else rows
+    return pd.DataFrame({'topic': series['topic'], 'ts': series['ts'], 'value': series['numeric_message']})
+
+# Chart series from the query service's aggregates (/series?resolution=1m|1h):
+# topic, ts (bucket start), the bucket mean as value, min and max
+def rollup_series(data, topics):
+    series = pd.DataFrame(data)
+    series['topic'] = topic_categories(series['topic_id'], topics)
+    return series[['topic', 'ts', 'value', 'min', 'max']]
+
+# Length in milliseconds of a statistics window label such as '5m' or '24h'
+def span_length(label):
+    return int(label[:-1]) * {'s': 1000, 'm': 60 * 1000, 'h': 60 * 60 * 1000, 'd': 24 * 60 * 60 * 1000}[label[-1]]
+
+# One row per topic from the query service's /stats: the time since its last
+# reading and, for each window from the shortest up, the count, mean,
+# standard deviation and change per minute. now is epoch ms.
+def health_table(stats, now):
+    # A column that is null in every row (e.g. std with one reading per
+    # window) arrives as objects, which cannot be rounded
+    stats = stats.assign(**{column: pd.to_numeric(stats[column], errors='coerce')
+                            for column in ('last_ts', 'count', 'mean', 'std', 'rate')})
+    windows = stats[stats['span'] != 'all']
+    table = stats.groupby('topic', observed=True)['last_ts'].max().to_frame()
+    table = pd.DataFrame({'Last reading (s ago)': ((now - table['last_ts']) / 1000).round().astype('Int64')}, index=table.index)
+    for span in sorted(windows['span'].unique(), key=span_length):
+        rows = windows[windows['span'] == span].set_index('topic')
+        table[f'{span} count'] = rows['count']
+        table[f'{span} mean'] = rows['mean'].round(2)
+        table[f'{span} std'] = rows['std'].round(2)
+        table[f'{span} °C/min'] = rows['rate'].round(3)
+    return table.reset_index().rename(columns={'topic': 'Topic'})
+
+# Builds the Vega-Lite spec for the chart. The browser draws it, so the
+# server only ships the (downsampled) points. rules are the alarm rules the
+# threshold lines follow.
+def chart_spec(series, resolution, rules):
+    data = series.round(2)
+    x = alt.X('ts:T', title='Time')
+    y = alt.Y('value:Q', title='Temperature (°C)', scale=alt.Scale(zero=False))
+    color = alt.Color('topic:N', title='Topic')
+    lines = alt.Chart(data).mark_line(point=resolution == 'raw', strokeWidth=3).encode(
+        x=x, y=y, color=color, tooltip=['topic', 'ts:T', 'value'])
+    layers = [lines]
+    if resolution != 'raw':
+        # Min-max range of each bucket around the mean line
+        layers.insert(0, alt.Chart(data).mark_area(opacity=0.2).encode(x=x, y='min:Q', y2='max:Q', color=color))
+    thresholds = alt.Chart(threshold_lines(rules)).mark_rule(strokeDash=[8, 4], opacity=0.7).encode(
+        y='value:Q', color=alt.Color('color:N', scale=None), tooltip=['label'])
+    layers.append(thresholds)
+    chart = alt.layer(*layers).properties(height=600).configure_axis(labelFontSize=16, titleFontSize=20).configure_legend(labelFontSize=16, titleFontSize=18)
+    return chart.to_dict()
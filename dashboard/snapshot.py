@@ -0,0 +1,196 @@
+import os
+import threading
+import time
+
+import pandas as pd
+
+from series import (TIME_SPANS, WINDOW_ROWS, match_topics, topic_categories, append_rows,
+                    choose_resolution, raw_series, rollup_series, chart_spec)
+
+# One refresher per dashboard process keeps the data every session shows.
+# It polls the query service's /version and, when the ingester has committed,
+# reads the new rows once and publishes fresh snapshots. Sessions only pick up the
+# current snapshot, so the query load follows the number of distinct topic
+# filters in use, not the number of people watching.
+#
+# A snapshot is never changed after it is published; sessions must not modify
+# its frames either.
+
+# A filter no session has asked for in this many seconds stops being refreshed
+VIEW_IDLE = float(os.environ.get('VIEW_IDLE', '300'))
+
+
+class Snapshot:
+    def __init__(self, topic_ids, window, cursor, topics, latest, stats, events, alarms, build_chart):
+        # Selected topic ids, None for all topics
+        self.topic_ids = topic_ids
+        # Newest rows by time, oldest first (see series.append_rows); None
+        # when the table is empty
+        self.window = window
+        # Query service cursor of the last rows read into the window
+        self.cursor = cursor
+        self.topics = topics
+        # Latest reading and rolling statistics per selected topic, the
+        # recent alarm transitions, and the alarm engine's rules and the
+        # state of each rule (the query service's /alarms)
+        self.latest = latest
+        self.stats = stats
+        self.events = events
+        self.alarms = alarms
+        self.build_chart = build_chart
+        self.charts = {}
+        self.lock = threading.Lock()
+
+    # (resolution, Vega-Lite spec) for a TIME_SPANS label; the spec is None
+    # when there is nothing to draw. Built by the first session that asks,
+    # the others wait for it and share the result.
+    def chart(self, span_label):
+        with self.lock:
+            if span_label not in self.charts:
+                self.charts[span_label] = self.build_chart(self, TIME_SPANS[span_label])
+            return self.charts[span_label]
+
+
+class Refresher:
+    # client is a query_client.QueryClient; refresh_seconds is an optional
+    # metrics.Histogram for the refresh time
+    def __init__(self, client, poll, refresh_seconds=None):
+        self.client = client
+        self.poll = poll
+        self.refresh_seconds = refresh_seconds
+        # Topic filter (tuple of topic ids, None = all) -> current snapshot
+        self.snapshots = {}
+        self.last_read = {}
+        self.refresh_lock = threading.Lock()
+        self.data_version = None
+        self.topics = pd.DataFrame({'id': pd.Series(dtype='int64'), 'name': pd.Series(dtype='object')})
+        # Last refresh error, None when the last refresh worked
+        self.error = None
+        self.refresh()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # A topic filter as the topic_id parameter: None for all topics, a list
+    # (possibly empty) otherwise
+    @staticmethod
+    def topic_param(key):
+        return None if key is None else list(key)
+
+    def read_data_version(self):
+        return self.client.get_json('/version')['data_version']
+
+    # The snapshot for a topic filter text. A filter nobody has used yet is
+    # loaded right away; after that the background thread keeps it current.
+    def snapshot(self, pattern):
+        topic_ids = match_topics(self.topics, pattern)
+        key = None if topic_ids is None else tuple(topic_ids)
+        self.last_read[key] = time.monotonic()
+        snapshot = self.snapshots.get(key)
+        if snapshot is None:
+            self.refresh([key])
+            snapshot = self.snapshots[key]
+        return snapshot
+
+    # False once a newer snapshot has replaced this one
+    def is_current(self, snapshot):
+        return self.snapshots.get(snapshot.topic_ids) is snapshot
+
+    # Reads the new rows for the given filters (default: all in use) and
+    # publishes their snapshots
+    def refresh(self, keys=None):
+        with self.refresh_lock:
+            started = time.perf_counter()
+            try:
+                version = self.client.get_json('/version')
+                first_id, max_id = version['first_id'], version['max_id']
+                if keys is None:
+                    # Remember the version before reading, so a commit that
+                    # lands meanwhile triggers another refresh. Loading a
+                    # single new filter leaves it alone, so the others still
+                    # pick up what changed.
+                    self.data_version = version['data_version']
+                    # The unfiltered view is always kept current
+                    keys = list(set(self.snapshots) | {None})
+                data = {}
+                cursors = {}
+                for key in keys:
+                    previous = self.snapshots.get(key)
+                    window = previous.window if previous is not None else None
+                    cursors[key] = previous.cursor if previous is not None else 0
+                    data[key] = []
+                    if max_id is not None and max_id > cursors[key]:
+                        # The newest WINDOW_ROWS rows by time since the
+                        # cursor, so a long gap does not bring in everything
+                        # it missed. Once the window is full, rows older than
+                        # all of it (e.g. from a backfill) are not asked for.
+                        start = int(window['ts'].iloc[0]) if window is not None and len(window) >= WINDOW_ROWS else 0
+                        data[key], cursors[key] = self.client.get_frame('/series', resolution='raw', after=cursors[key], start=start,
+                                                                        limit=WINDOW_ROWS, topic_id=self.topic_param(key))
+                # Read after the rows, so every topic they refer to is in it
+                topics, _ = self.client.get_frame('/topics')
+                events, _ = self.client.get_frame('/events', limit=20)
+                events = events[['ts', 'rule', 'state', 'message']].assign(ts=pd.to_datetime(events['ts'], unit='ms'))
+                alarms = self.client.get_json('/alarms')
+
+                snapshots = {}
+                for key in keys:
+                    previous = self.snapshots.get(key)
+                    window = None
+                    if first_id is not None:
+                        # Rows deleted from the table (reset) are dropped from the window too
+                        window = append_rows(previous.window if previous is not None else None, data[key], first_id, topics)
+                    latest, _ = self.client.get_frame('/latest', topic_id=self.topic_param(key))
+                    latest = latest[['topic_id', 'value', 'ts']].rename(columns={'value': 'numeric_message'})
+                    latest['topic'] = topic_categories(latest['topic_id'], topics)
+                    latest['timestamp'] = pd.to_datetime(latest['ts'], unit='ms')
+                    stats, _ = self.client.get_frame('/stats', topic_id=self.topic_param(key))
+                    stats['topic'] = topic_categories(stats['topic_id'], topics)
+                    snapshots[key] = Snapshot(key, window, cursors[key], topics, latest, stats, events, alarms, self.build_chart)
+
+                self.topics = topics
+                self.snapshots.update(snapshots)
+                self.error = None
+            except Exception as e:
+                # Sessions keep showing the last good snapshots; a filter
+                # without one has nothing to show
+                self.error = str(e)
+                if any(key not in self.snapshots for key in keys or []):
+                    raise
+            finally:
+                if self.refresh_seconds is not None:
+                    self.refresh_seconds.observe(time.perf_counter() - started)
+
+    # Chart for a snapshot over the last span milliseconds (see Snapshot.chart)
+    def build_chart(self, snapshot, span):
+        window = snapshot.window
+        if window is None or window.empty:
+            return 'raw', None
+        start = int(time.time() * 1000) - span
+        resolution = choose_resolution(window, span, start)
+        if resolution == 'raw':
+            series = raw_series(window, start)
+        else:
+            # Aggregates by the span rather than the start, so every session
+            # asks the same question and the service answers from its cache
+            data, _ = self.client.get_frame('/series', resolution=resolution, span=span,
+                                            topic_id=self.topic_param(snapshot.topic_ids))
+            series = rollup_series(data, snapshot.topics)
+        return resolution, chart_spec(series, resolution, snapshot.alarms['rules']) if not series.empty else None
+
+    # Forgets the filters nobody has looked at for VIEW_IDLE seconds; the
+    # unfiltered view is always kept
+    def drop_idle(self):
+        now = time.monotonic()
+        for key in list(self.snapshots):
+            if key is not None and now - self.last_read.get(key, now) > VIEW_IDLE:
+                self.snapshots.pop(key, None)
+                self.last_read.pop(key, None)
+
+    def run(self):
+        while True:
+            time.sleep(self.poll)
+            try:
+                if self.read_data_version() != self.data_version:
+                    self.refresh()
+                self.drop_idle()
+            except Exception as e:
+                self.error = str(e)
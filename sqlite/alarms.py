@@ -0,0 +1,223 @@
+import json
+import os
+import threading
+import time
+
+# Streaming version of the dashboard's temperature rules, evaluated for every
+# reading as it arrives:
+#   critical - the lowest current temperature is at or above ALARM_LIMIT
+#              (no sensor is below the limit any more)
+#   band     - no current temperature is inside ALARM_BAND_MIN..ALARM_BAND_MAX
+# Each topic keeps two flags (below the limit, inside the band) with
+# hysteresis, and the rules only count flags, so a reading costs O(1) however
+# many sensors there are. A rule changes state only after its condition has
+# held for ALARM_DEBOUNCE seconds. Transitions are published (retained) to
+# ALARM_TOPIC/<rule> and stored in alarm_events.
+ALARM_LIMIT = float(os.environ.get('ALARM_LIMIT', '55'))
+ALARM_BAND_MIN = float(os.environ.get('ALARM_BAND_MIN', '59'))
+ALARM_BAND_MAX = float(os.environ.get('ALARM_BAND_MAX', '60'))
+ALARM_HYSTERESIS = float(os.environ.get('ALARM_HYSTERESIS', '0.5'))
+ALARM_DEBOUNCE = float(os.environ.get('ALARM_DEBOUNCE', '5'))
+ALARM_TOPIC = os.environ.get('ALARM_TOPIC', 'alarms')
+
+RULES = ('critical', 'band')
+
+# The topics transitions are published on. The ingester subscribes to
+# everything, so it gets its own retained transitions back; they are not
+# readings. Sensors publishing elsewhere under ALARM_TOPIC are.
+OWN_TOPICS = frozenset(f'{ALARM_TOPIC}/{rule}' for rule in RULES)
+
+
+def own_topic(topic):
+    return topic in OWN_TOPICS
+
+
+class Rules:
+    def __init__(self, limit=ALARM_LIMIT, band_min=ALARM_BAND_MIN, band_max=ALARM_BAND_MAX,
+                 hysteresis=ALARM_HYSTERESIS, debounce=ALARM_DEBOUNCE):
+        self.limit = limit
+        self.band_min = band_min
+        self.band_max = band_max
+        self.hysteresis = hysteresis
+        self.debounce = debounce
+
+    # Next value of a topic's "below the limit" flag
+    def below(self, previous, value):
+        if previous is None:
+            return value < self.limit
+        if previous:
+            return value < self.limit
+        return value < self.limit - self.hysteresis
+
+    # Next value of a topic's "inside the band" flag
+    def in_band(self, previous, value):
+        if previous is None or not previous:
+            return self.band_min <= value <= self.band_max
+        return self.band_min - self.hysteresis <= value <= self.band_max + self.hysteresis
+
+
+class AlarmEngine:
+    # publish(rule, event) is called for every transition
+    def __init__(self, rules=None, publish=None):
+        self.rules = rules or Rules()
+        self.publish = publish
+        # topic -> [value, below, in_band, ts of the reading]
+        self.topics = {}
+        self.below_count = 0
+        self.in_band_count = 0
+        self.active = {rule: False for rule in RULES}
+        self.pending_since = {rule: None for rule in RULES}
+        # Transitions not yet written to alarm_events
+        self.events = []
+        self.lock = threading.Lock()
+
+    # Picks up where the last run stopped: the latest value per topic and
+    # the last stored state of each rule
+    def restore(self, conn):
+        for rule, state in conn.execute('SELECT rule, state FROM alarm_events WHERE id IN (SELECT max(id) FROM alarm_events GROUP BY rule)'):
+            if rule in self.active:
+                self.active[rule] = state == 'raised'
+        for topic, value, ts in conn.execute('SELECT name, value, ts FROM temp_latest JOIN topics ON topics.id = temp_latest.topic_id'):
+            if not own_topic(topic):
+                self.update_topic(topic, value, ts)
+
+    # A reading older than the topic's newest one (ts in epoch ms, None when
+    # unknown) is left out, so the current value is the one temp_latest keeps
+    # even when readings arrive out of order (see ingester.Worker)
+    def update_topic(self, topic, value, ts=None):
+        state = self.topics.get(topic)
+        if state is None:
+            state = self.topics[topic] = [value, None, None, ts]
+        elif ts is not None and state[3] is not None and ts < state[3]:
+            return
+        below = self.rules.below(state[1], value)
+        in_band = self.rules.in_band(state[2], value)
+        self.below_count += int(below) - int(bool(state[1]))
+        self.in_band_count += int(in_band) - int(bool(state[2]))
+        state[0] = value
+        state[1] = below
+        state[2] = in_band
+        if ts is not None:
+            state[3] = ts
+
+    def conditions(self):
+        seen = len(self.topics) > 0
+        return {
+            'critical': seen and self.below_count == 0,
+            'band': seen and self.in_band_count == 0,
+        }
+
+    # Feeds one reading through the rules. ts (epoch ms) is when it arrived,
+    # not the device's timestamp: debounce runs on the same clock as tick(),
+    # so a reading stamped long ago cannot complete a debounce at once.
+    def process(self, topic, value, ts):
+        if value is None or own_topic(topic):
+            return
+        with self.lock:
+            self.update_topic(topic, value)
+            self.evaluate(ts)
+
+    # Feeds the (topic, value, message, ts) rows of a message or chunk
+    # through the rules, all having arrived at ts; the same as process() for
+    # every row. Evaluating again with unchanged conditions at the same ts
+    # changes nothing, so the rules are only evaluated where a row changes
+    # them.
+    def process_rows(self, rows, ts):
+        with self.lock:
+            evaluated = None
+            for topic, value, _message, reading_ts in rows:
+                if value is None or own_topic(topic):
+                    continue
+                self.update_topic(topic, value, reading_ts)
+                conditions = (self.below_count == 0, self.in_band_count == 0)
+                if conditions != evaluated:
+                    self.evaluate(ts)
+                    evaluated = conditions
+
+    # Lets pending transitions complete while no readings arrive
+    def tick(self, ts=None):
+        with self.lock:
+            self.evaluate(int(time.time() * 1000) if ts is None else ts)
+
+    def evaluate(self, ts):
+        for rule, condition in self.conditions().items():
+            if condition == self.active[rule]:
+                self.pending_since[rule] = None
+                continue
+            if self.pending_since[rule] is None:
+                self.pending_since[rule] = ts
+            if ts - self.pending_since[rule] >= self.rules.debounce * 1000:
+                self.active[rule] = condition
+                self.pending_since[rule] = None
+                self.transition(rule, condition, ts)
+
+    def transition(self, rule, raised, ts):
+        # Name the sensor that explains the new state
+        flag = 1 if rule == 'critical' else 2
+        topic = value = None
+        if raised:
+            values = sorted((state[0], topic) for topic, state in self.topics.items())
+            value, topic = values[0] if rule == 'critical' else values[-1]
+        elif self.topics:
+            topic = next(topic for topic, state in self.topics.items() if state[flag])
+            value = self.topics[topic][0]
+        limit, band = f'{self.rules.limit:g}°C', f'{self.rules.band_min:g}-{self.rules.band_max:g}°C'
+        if topic is None:
+            # A rule restored as raised, or raised before a reset, with no
+            # reading since: no sensor holds it up any more
+            message = 'No temperature readings'
+        elif rule == 'critical':
+            message = (f'Lowest temperature ({topic}: {value:.1f}°C) is not below {limit}' if raised
+                       else f'{topic} is back below {limit} ({value:.1f}°C)')
+        else:
+            message = (f'No temperature in the {band} range. Highest: {topic}: {value:.1f}°C' if raised
+                       else f'{topic} is in the {band} range ({value:.1f}°C)')
+        event = {
+            'rule': rule,
+            'state': 'raised' if raised else 'cleared',
+            'ts': ts,
+            'topic': topic,
+            'value': value,
+            'message': message,
+        }
+        self.events.append(event)
+        if self.publish:
+            self.publish(rule, event)
+
+    # Forgets every topic and clears the raised rules, e.g. after the data
+    # has been reset, so the stored and published state says so too
+    def clear(self, ts=None):
+        with self.lock:
+            self.topics = {}
+            self.below_count = 0
+            self.in_band_count = 0
+            for rule in RULES:
+                self.pending_since[rule] = None
+                if self.active[rule]:
+                    self.active[rule] = False
+                    self.transition(rule, False, int(time.time() * 1000) if ts is None else ts)
+
+    # Returns and forgets the transitions since the last call
+    def take_events(self):
+        with self.lock:
+            events, self.events = self.events, []
+        return events
+
+    # Puts back transitions whose write failed, ahead of any newer ones
+    def return_events(self, events):
+        with self.lock:
+            self.events[:0] = events
+
+
+def store_events(conn, events):
+    if events:
+        conn.executemany('INSERT INTO alarm_events (rule, state, ts, topic, value, message) VALUES (?, ?, ?, ?, ?, ?)',
+                         [(e['rule'], e['state'], e['ts'], e['topic'], e['value'], e['message']) for e in events])
+
+
+# Publishes transitions retained, so a client subscribing later still gets
+# the current state of each rule
+def mqtt_publisher(client):
+    def publish(rule, event):
+        client.publish(f'{ALARM_TOPIC}/{rule}', json.dumps(event), qos=1, retain=True)
+    return publish
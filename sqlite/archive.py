@@ -0,0 +1,195 @@
+import glob
+import itertools
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import alarms
+
+# Cold tier: raw rows older than RETENTION_DAYS are moved out of SQLite into
+# compressed Parquet files, one directory per UTC day:
+#   archive/day=2025-05-20/part-<first id>-<last id>.parquet
+# The rollup tables and temp_latest stay in SQLite.
+DB_PATH = os.environ.get('DB_PATH', '/sqlite/data/temperatur.db')
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(os.path.dirname(DB_PATH), 'archive'))
+RETENTION_DAYS = float(os.environ.get('RETENTION_DAYS', '30'))
+
+# Rows moved per transaction. Each chunk is its own short transaction so the
+# ingester's batches slot in between them.
+ARCHIVE_CHUNK = int(os.environ.get('ARCHIVE_CHUNK', '200000'))
+
+# The dashboard asks for a reset by creating this file; the ingester carries
+# it out between two batches so the writer never waits on another connection
+RESET_REQUEST = os.path.join(os.path.dirname(DB_PATH), 'reset.request')
+
+DAY = 24 * 60 * 60 * 1000
+
+SCHEMA = pa.schema([
+    ('id', pa.int64()),
+    ('topic', pa.string()),
+    ('value', pa.float64()),
+    ('message', pa.string()),
+    ('ts', pa.int64()),
+])
+
+
+def day_name(ts):
+    return datetime.fromtimestamp(ts / 1000, tz=timezone.utc).strftime('%Y-%m-%d')
+
+
+def partition_dir(archive_dir, ts):
+    return os.path.join(archive_dir, f'day={day_name(ts)}')
+
+
+def retention_cutoff():
+    return int((time.time() - RETENTION_DAYS * 24 * 60 * 60) * 1000)
+
+
+# Moves up to ARCHIVE_CHUNK rows older than cutoff (epoch ms) from the oldest
+# day still in SQLite to Parquet, then deletes them. Returns the number of
+# rows moved, 0 when there is nothing left to do. The file is written before
+# the delete commits; a crash in between writes the same id range to the
+# same file name again on the next run.
+def archive_chunk(conn, archive_dir, cutoff):
+    oldest = conn.execute('SELECT min(ts) FROM temp').fetchone()[0]
+    if oldest is None or oldest >= cutoff:
+        return 0
+    # Never let a chunk cross a day boundary
+    day_end = min(oldest - oldest % DAY + DAY, cutoff)
+    # The Parquet files carry the topic names, so they can be read without the database
+    rows = conn.execute('SELECT id, (SELECT name FROM topics WHERE topics.id = topic_id), value, message, ts FROM temp WHERE ts >= ? AND ts < ? ORDER BY ts LIMIT ?',
+                        (oldest, day_end, ARCHIVE_CHUNK)).fetchall()
+    if not rows:
+        return 0
+
+    columns = list(zip(*rows))
+    table = pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, SCHEMA)], schema=SCHEMA)
+    directory = partition_dir(archive_dir, oldest)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'part-{min(columns[0])}-{max(columns[0])}.parquet')
+    pq.write_table(table, path + '.tmp', compression='zstd')
+    os.replace(path + '.tmp', path)
+
+    with conn:
+        conn.executemany('DELETE FROM temp WHERE id = ?', [(row_id,) for row_id in columns[0]])
+    return len(rows)
+
+
+# Clears everything: the Parquet partitions are dropped as whole directories,
+# the SQLite tables are emptied in one transaction. alarm_events is kept as
+# the alarm history; the ingester records the raised rules as cleared.
+def reset(conn, archive_dir):
+    if os.path.isdir(archive_dir):
+        for directory in glob.glob(os.path.join(archive_dir, 'day=*')):
+            shutil.rmtree(directory, ignore_errors=True)
+    with conn:
+        for table in ('temp', 'temp_1m', 'temp_1h', 'temp_latest', 'topic_stats', 'topics'):
+            conn.execute(f'DELETE FROM {table}')
+
+
+# Parquet files of the day partitions overlapping start <= ts < end (epoch
+# ms), oldest day first. Day names sort like the days, and nothing is
+# archived in the future.
+def partition_files(archive_dir, start, end):
+    first_day = day_name(max(start, 0))
+    last_day = day_name(min(end - 1, int(time.time() * 1000)))
+    paths = []
+    for directory in sorted(glob.glob(os.path.join(archive_dir, 'day=*'))):
+        if first_day <= os.path.basename(directory)[len('day='):] <= last_day:
+            # part-<first id>-<last id>: the chunks of a day in the order they were moved
+            paths.extend(sorted(glob.glob(os.path.join(directory, 'part-*.parquet')),
+                                key=lambda path: int(os.path.basename(path).split('-')[1])))
+    return paths
+
+
+# Archived rows of the given Parquet files with start <= ts < end
+def read_cold(paths, start, end, topics=None):
+    filters = [('ts', '>=', start), ('ts', '<', end)]
+    if topics is not None:
+        filters.append(('topic', 'in', list(topics)))
+    cold = pq.read_table(paths, filters=filters, schema=SCHEMA).to_pandas()
+    # Alarm transitions archived before schema version 7 (see schema.py)
+    return cold[~cold['topic'].astype(str).map(alarms.own_topic).astype(bool)]
+
+
+# Query and parameters of the rows in SQLite with start <= ts < end
+def hot_query(start, end, topics=None):
+    query = 'SELECT id, (SELECT name FROM topics WHERE topics.id = topic_id) AS topic, value, message, ts FROM temp WHERE ts >= ? AND ts < ?'
+    params = [start, end]
+    if topics is not None:
+        topics = list(topics)
+        query += f" AND topic_id IN (SELECT id FROM topics WHERE name IN ({', '.join('?' * len(topics))}))"
+        params.extend(topics)
+    return query, params
+
+
+# The frames of both tiers as one, oldest first
+def combine(frames):
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return pd.DataFrame(columns=SCHEMA.names)
+    # A row can briefly exist in both tiers while it is being moved
+    result = pd.concat(frames, ignore_index=True).drop_duplicates('id')
+    return result.sort_values(['ts', 'id'], ignore_index=True)
+
+
+# Raw rows with start <= ts < end (epoch ms) from both tiers as one frame with
+# the temp columns, oldest first. topics limits the result to those topics.
+def read_range(conn, archive_dir, start, end, topics=None):
+    frames = []
+
+    # Cold tier: only the day partitions overlapping the range are opened
+    paths = partition_files(archive_dir, start, end)
+    if paths:
+        frames.append(read_cold(paths, start, end, topics))
+
+    # Hot tier
+    query, params = hot_query(start, end, topics)
+    frames.append(pd.read_sql_query(query, conn, params=params))
+    return combine(frames)
+
+
+# The newest limit rows of read_range. SQLite hands over its newest rows in
+# ts order from the temp_ts index; the archive, which only has older rows, is
+# read newest day first and only for what the hot tier does not fill.
+def read_newest(conn, archive_dir, start, end, limit, topics=None):
+    query, params = hot_query(start, end, topics)
+    hot = pd.read_sql_query(query + ' ORDER BY ts DESC, id DESC LIMIT ?', conn, params=params + [limit])
+    frames = [hot]
+    missing = limit - len(hot)
+    if missing > 0:
+        days = [list(paths) for _day, paths in itertools.groupby(partition_files(archive_dir, start, end), os.path.dirname)]
+        for paths in reversed(days):
+            cold = read_cold(paths, start, end, topics)
+            frames.append(cold)
+            missing -= len(cold)
+            if missing <= 0:
+                break
+    return combine(frames).tail(limit).reset_index(drop=True)
+
+
+# Runs the retention job once, e.g. from cron or by hand:
+#   python3 archive.py
+def main():
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute('PRAGMA busy_timeout=30000')
+    cutoff = retention_cutoff()
+    moved = 0
+    started = time.monotonic()
+    while True:
+        count = archive_chunk(conn, ARCHIVE_DIR, cutoff)
+        if count == 0:
+            break
+        moved += count
+    print(f'Archived {moved} rows older than {day_name(cutoff)} to {ARCHIVE_DIR} in {time.monotonic() - started:.1f} s')
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+import argparse
+import glob
+import os
+import sqlite3
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+import archive
+import latest
+import payloads
+import rollups
+import schema
+import topic_stats
+
+# Bulk import of historical readings straight into temperatur.db, without
+# replaying them through MQTT:
+#   python3 backfill.py old-logger.csv
+#   python3 backfill.py /mnt/site2/temperatur.db /mnt/site2/archive
+# A source is
+#   .csv         columns topic and ts plus value and/or message, like the
+#                output of export.py; ts is epoch ms or an ISO time (UTC
+#                unless it says otherwise)
+#   .parquet     the same columns; a directory is read as all the Parquet
+#                files under it, e.g. another site's archive
+#   .db/.sqlite  another temperatur.db (version 1 or later, see schema.py)
+# Rows without a usable ts are skipped and counted; text in value is stored
+# as a message, as the ingester does.
+#
+# Rows are loaded BACKFILL_CHUNK at a time, each chunk in one transaction.
+# A chunk is staged in memory: rows whose (topic, ts) repeat within it or are
+# already stored, hot or archived, are dropped, the rest is sorted by time and
+# inserted in one go, so the indexes of temp are updated in order. The
+# rollups, temp_latest and the 'all' rows of topic_stats get the chunk's
+# aggregates, one upsert per bucket and topic rather than per row.
+#
+# Each chunk is its own transaction, short enough for the ingester's
+# busy_timeout, so the ingester keeps running: it waits for a chunk at most
+# and picks up the new totals before its next batch. Rows older than the
+# retention period are moved to the archive by the ingester as usual.
+DB_PATH = os.environ.get('DB_PATH', '/sqlite/data/temperatur.db')
+BACKFILL_CHUNK = int(os.environ.get('BACKFILL_CHUNK', '100000'))
+
+# Seconds between two progress lines
+PROGRESS_INTERVAL = 5
+
+COLUMNS = ['topic', 'value', 'message', 'ts']
+
+
+# Parquet files of a file or directory, in name order
+def parquet_paths(path):
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, '**', '*.parquet'), recursive=True))
+    return [path]
+
+
+def csv_chunks(path):
+    # value and the text columns are read as strings, so a first block
+    # without readings or messages does not fix the wrong type, and text in
+    # value does not stop the import; normalize() parses the numbers
+    reader = pa_csv.open_csv(path, read_options=pa_csv.ReadOptions(block_size=16 << 20),
+                             convert_options=pa_csv.ConvertOptions(
+                                 column_types={'topic': pa.string(), 'value': pa.string(), 'message': pa.string()}))
+    for batch in reader:
+        yield batch.to_pandas()
+
+
+def parquet_chunks(path):
+    for file in parquet_paths(path):
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=BACKFILL_CHUNK):
+            yield batch.to_pandas()
+
+
+# Rows of another temperatur.db in id order, one short read at a time
+def sqlite_chunks(path):
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    conn.execute('PRAGMA busy_timeout=5000')
+    if schema.schema_version(conn) < 1:
+        sys.exit(f'{path} has the legacy layout; upgrade a copy of it with migrate.py first')
+    topic = '(SELECT name FROM topics WHERE topics.id = topic_id)' if 'topic_id' in schema.table_columns(conn, 'temp') else 'topic'
+    last_id = -1
+    while True:
+        frame = pd.read_sql_query(f'SELECT id, {topic} AS topic, value, message, ts FROM temp WHERE id > ? ORDER BY id LIMIT ?',
+                                  conn, params=(last_id, BACKFILL_CHUNK))
+        if frame.empty:
+            break
+        last_id = int(frame['id'].iloc[-1])
+        yield frame
+    conn.close()
+
+
+def source_chunks(path):
+    if os.path.isdir(path) or path.endswith('.parquet'):
+        return parquet_chunks(path)
+    if path.endswith(('.db', '.sqlite', '.sqlite3')):
+        return sqlite_chunks(path)
+    return csv_chunks(path)
+
+
+# The chunk as (topic, value, message, ts) with ts in epoch ms, and the
+# number of rows dropped for their ts. Like the ingester, a row keeps its
+# message only when it has no numeric value, text that is not a number is a
+# message, and non-finite values are kept as text. A row without a ts, or
+# with one the ingester would not take from a device either (before 1970 or
+# ahead of now, see payloads.reading_ts), cannot be placed and is dropped.
+def normalize(frame):
+    missing = {'topic', 'ts'} - set(frame.columns)
+    if missing or not {'value', 'message'} & set(frame.columns):
+        raise ValueError(f'Columns topic, ts and value or message are needed, got {list(frame.columns)}')
+    ts = frame['ts']
+    if pd.api.types.is_datetime64_any_dtype(ts) or not pd.api.types.is_numeric_dtype(ts):
+        stamps = pd.to_datetime(ts, utc=True, format='ISO8601', errors='coerce')
+        ts = pd.Series(stamps.dt.as_unit('ms').array.asi8, index=frame.index).where(stamps.notna())
+    ts = ts.astype('float64')
+    placed = ts.notna() & (ts >= 0) & (ts <= time.time() * 1000 + payloads.MAX_CLOCK_SKEW * 1000)
+    skipped = int((~placed).sum())
+    frame, ts = frame[placed], ts[placed].astype('int64')
+
+    message = frame['message'].astype(object) if 'message' in frame else pd.Series(None, index=frame.index, dtype=object)
+    value = frame['value'] if 'value' in frame else pd.Series(np.nan, index=frame.index)
+    if not pd.api.types.is_numeric_dtype(value):
+        # Text in the value column: numbers are readings, the rest messages
+        text = value.astype(object)
+        value = pd.to_numeric(text, errors='coerce').astype('float64')
+        unparsed = text.notna() & ~np.isfinite(value)
+        value = value.where(~unparsed)
+        message = message.mask(unparsed & message.isna(), text.astype(str))
+    value = value.astype('float64')
+    # A message that is a number is a reading, as in the ingester
+    text = value.isna() & message.notna()
+    if text.any():
+        parsed = pd.to_numeric(message.where(text), errors='coerce').astype('float64')
+        value = value.where(~text | ~np.isfinite(parsed), parsed)
+    finite = np.isfinite(value)
+    message = message.where(message.notna() & ~finite, None)
+    infinite = value.notna() & ~finite
+    if infinite.any():
+        message = message.mask(infinite, value[infinite].astype(str))
+        value = value.where(finite)
+    result = pd.DataFrame({'topic': frame['topic'].astype(object), 'value': value, 'message': message, 'ts': ts})
+    return result[result['topic'].notna() & (result['value'].notna() | result['message'].notna())], skipped
+
+
+class Backfill:
+    def __init__(self, conn, archive_dir):
+        self.conn = conn
+        self.archive_dir = archive_dir
+        self.read = 0
+        self.inserted = 0
+        # Rows dropped by normalize() for their ts
+        self.skipped = 0
+
+    # The rows whose (topic, ts) is not in the archive yet
+    def drop_archived(self, frame):
+        start, end = int(frame['ts'].min()), int(frame['ts'].max()) + 1
+        paths = archive.partition_files(self.archive_dir, start, end)
+        if not paths:
+            return frame
+        keys = pq.read_table(paths, columns=['topic', 'ts'], schema=archive.SCHEMA,
+                             filters=[('ts', '>=', start), ('ts', '<', end), ('topic', 'in', frame['topic'].unique().tolist())]).to_pandas()
+        if keys.empty:
+            return frame
+        keys = keys.astype({'topic': object}).drop_duplicates()
+        merged = frame.merge(keys, on=['topic', 'ts'], how='left', indicator=True)
+        return merged.loc[merged['_merge'] == 'left_only', COLUMNS]
+
+    # The rows whose (topic_id, ts) is not in temp yet. Each topic's own
+    # range is looked up in temp_topic_ts, so a chunk of a few topics does
+    # not read every topic's rows of its time range.
+    def drop_stored(self, frame):
+        ranges = frame.groupby('topic_id')['ts'].agg(['min', 'max'])
+        keys = pd.concat([pd.read_sql_query('SELECT topic_id, ts FROM temp WHERE topic_id = ? AND ts >= ? AND ts <= ?', self.conn,
+                                            params=(int(topic_id), int(start), int(end)))
+                          for topic_id, start, end in ranges.itertuples(name=None)], ignore_index=True)
+        if keys.empty:
+            return frame
+        merged = frame.merge(keys.drop_duplicates(), on=['topic_id', 'ts'], how='left', indicator=True)
+        return merged.loc[merged['_merge'] == 'left_only', COLUMNS + ['topic_id']]
+
+    # Loads one normalized chunk; returns the number of new rows
+    def load(self, frame):
+        self.read += len(frame)
+        frame = frame.drop_duplicates(['topic', 'ts'])
+        if not frame.empty:
+            frame = self.drop_archived(frame)
+        if frame.empty:
+            return 0
+        conn = self.conn
+        with conn:
+            # Holding the write lock from the start, so no row with a key of
+            # the chunk can be committed between the check and the insert
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('INSERT OR IGNORE INTO topics (name) VALUES (?)', [(name,) for name in frame['topic'].unique()])
+            frame = frame.assign(topic_id=frame['topic'].map(dict(conn.execute('SELECT name, id FROM topics'))))
+            frame = self.drop_stored(frame)
+            if frame.empty:
+                return 0
+            # Sorted by time, so ids follow time within the chunk and the
+            # temp_ts index is appended to in order
+            frame = frame.sort_values('ts', kind='stable')
+            value = frame['value'].astype(object).where(frame['value'].notna(), None)
+            conn.executemany('INSERT INTO temp (topic_id, value, message, ts) VALUES (?, ?, ?, ?)',
+                             zip(frame['topic_id'].tolist(), value.tolist(), frame['message'].tolist(), frame['ts'].tolist()))
+
+            # The derived tables get the chunk's aggregates, computed here
+            # rather than row by row
+            numeric = frame[frame['value'].notna()]
+            for table, width in rollups.ROLLUPS.items():
+                buckets = numeric.groupby([numeric['ts'] - numeric['ts'] % width, 'topic_id'])['value'].agg(['count', 'sum', 'min', 'max'])
+                rollups.merge_buckets(conn, table, buckets.reset_index().itertuples(index=False, name=None))
+            newest = numeric.loc[numeric.groupby('topic_id')['ts'].idxmax()]
+            latest.update_latest(conn, zip(newest['topic_id'].tolist(), newest['value'].tolist(), newest['message'].tolist(), newest['ts'].tolist()))
+            totals = numeric.groupby('topic_id').agg(count=('value', 'count'), sum=('value', 'sum'), min=('value', 'min'),
+                                                     max=('value', 'max'), last_ts=('ts', 'max'))
+            topic_stats.add_totals(conn, totals.reset_index().itertuples(index=False, name=None))
+        self.inserted += len(frame)
+        return len(frame)
+
+    # Retries a chunk while the database is locked for longer than busy_timeout
+    def load_retrying(self, frame):
+        while True:
+            try:
+                return self.load(frame)
+            except sqlite3.OperationalError as e:
+                self.read -= len(frame)
+                print(f'Database busy, retrying: {e}', file=sys.stderr, flush=True)
+                time.sleep(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk import historical readings into temperatur.db')
+    parser.add_argument('sources', nargs='+', help='CSV or Parquet files, directories of Parquet files, or SQLite databases')
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--archive', help='archive directory (default: next to the database)')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=30000')
+    for version in schema.ensure_schema(conn):
+        print(f'Database schema upgraded to version {version}', file=sys.stderr)
+    backfill = Backfill(conn, args.archive or os.path.join(os.path.dirname(os.path.abspath(args.db)), 'archive'))
+
+    started = time.perf_counter()
+    last_report = started
+    for source in args.sources:
+        for chunk in source_chunks(source):
+            # CSV blocks are sized in bytes; split them into chunks of rows
+            for offset in range(0, len(chunk), BACKFILL_CHUNK):
+                frame, skipped = normalize(chunk.iloc[offset:offset + BACKFILL_CHUNK])
+                backfill.skipped += skipped
+                backfill.load_retrying(frame)
+            now = time.perf_counter()
+            if now - last_report >= PROGRESS_INTERVAL:
+                print(f'{backfill.read} rows read, {backfill.inserted} new ({backfill.read / (now - started):.0f} rows/s)',
+                      file=sys.stderr, flush=True)
+                last_report = now
+    elapsed = time.perf_counter() - started
+    print(f'Imported {backfill.inserted} of {backfill.read} rows ({backfill.read - backfill.inserted} already stored) '
+          f'in {elapsed:.1f} s ({backfill.read / max(elapsed, 1e-9):.0f} rows/s)', file=sys.stderr)
+    if backfill.skipped:
+        print(f'Skipped {backfill.skipped} rows without a usable ts', file=sys.stderr)
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+import alarms
+import archive
+import export
+
+# Replays stored readings through the rules of alarms.py, to see how a rule
+# set would have behaved over past weeks before changing it:
+#   python3 backtest.py --start 2025-03-01 --variant limit=54.5 --variant band_min=58.5,debounce=30
+# Every variant is a set of Rules parameters (limit, band_min, band_max,
+# hysteresis, debounce) over the current settings, which always come first.
+# For each variant and rule (critical is the alarm, band the warning) it
+# prints how often the rule was raised, for how long in total and at most;
+# --intervals writes every raised interval to a CSV file.
+#
+# The engine works on whole arrays rather than reading by reading, with the
+# same results as AlarmEngine fed the same readings in (ts, id) order:
+#   - a topic's flag (below the limit, inside the band) is set or cleared by
+#     the readings outside the hysteresis margin and carried forward per
+#     topic through the readings inside it (a forward fill in topic order)
+#   - the number of topics with the flag set after every reading is the
+#     running sum of the flags' changes, and a rule's condition holds where
+#     it is 0
+#   - debounce works on runs of equal conditions: a run that differs from
+#     the rule's state and lasts longer than the debounce time flips the state,
+#     debounce after the run started, as if the engine ticked continuously
+# The replay starts like a fresh engine: no topic seen, both rules cleared.
+# The ingester feeds the engine arrival times; the replay uses the stored
+# timestamps, as if every reading had arrived when it was taken.
+DB_PATH = os.environ.get('DB_PATH', '/sqlite/data/temperatur.db')
+
+PARAMETERS = ('limit', 'band_min', 'band_max', 'hysteresis', 'debounce')
+
+
+# Numeric readings with start <= ts < end (epoch ms) from both tiers,
+# oldest first, as (ts, topic code, value) arrays and the topic names
+def load_readings(conn, archive_dir, start, end, topics=None):
+    frames = []
+    paths = archive.partition_files(archive_dir, start, end)
+    if paths:
+        filters = [('ts', '>=', start), ('ts', '<', end)]
+        if topics is not None:
+            filters.append(('topic', 'in', list(topics)))
+        frames.append(pq.read_table(paths, columns=['id', 'topic', 'value', 'ts'], filters=filters,
+                                    schema=archive.SCHEMA).to_pandas())
+    # Read through the temp_ts index, which covers these columns; the names
+    # are added afterwards
+    query = 'SELECT id, topic_id, value, ts FROM temp WHERE ts >= ? AND ts < ? AND value IS NOT NULL'
+    params = [start, end]
+    if topics is not None:
+        topics = list(topics)
+        query += f" AND topic_id IN (SELECT id FROM topics WHERE name IN ({', '.join('?' * len(topics))}))"
+        params.extend(topics)
+    hot = pd.read_sql_query(query, conn, params=params)
+    names = dict(conn.execute('SELECT id, name FROM topics'))
+    frames.append(hot.assign(topic=hot.pop('topic_id').map(names)))
+
+    frame = pd.concat([frame for frame in frames if not frame.empty] or frames, ignore_index=True)
+    frame = frame[frame['value'].notna() & ~frame['topic'].astype(str).map(alarms.own_topic).astype(bool)]
+    # A row can briefly exist in both tiers while it is being moved
+    frame = frame.drop_duplicates('id')
+    order = np.lexsort((frame['id'].to_numpy(), frame['ts'].to_numpy()))
+    codes, names = pd.factorize(frame['topic'].to_numpy()[order])
+    return frame['ts'].to_numpy(np.int64)[order], codes, frame['value'].to_numpy(np.float64)[order], names
+
+
+# The readings grouped by topic, in their order within each topic, and
+# where each topic's readings start; shared by all variants
+def topic_order(codes):
+    # A stable sort of 16-bit keys is a radix sort
+    order = np.argsort(codes.astype(np.int16) if codes.max(initial=0) < 2 ** 15 else codes, kind='stable')
+    grouped = codes[order]
+    return order, np.concatenate(([True], grouped[1:] != grouped[:-1]))
+
+
+# A topic's flag after every reading: True where on, False where off,
+# otherwise the topic's previous flag, or initial before it has one. In
+# topic order the previous flag is a forward fill that restarts at every
+# topic's first reading.
+def topic_flags(grouping, on, off, initial):
+    order, first = grouping
+    state = np.where(on, 1, np.where(off, 0, -1)).astype(np.int8)[order]
+    state[first & (state < 0)] = initial
+    filled = np.maximum.accumulate(np.where(state >= 0, np.arange(len(state)), 0))
+    flags = np.empty(len(state), bool)
+    flags[order] = state[filled] == 1
+    return flags
+
+
+# Number of topics with the flag set after every reading
+def flag_count(grouping, flags):
+    order, first = grouping
+    grouped = flags[order]
+    previous = np.concatenate(([False], grouped[:-1]))
+    previous[first] = False
+    change = np.empty(len(flags), np.int64)
+    change[order] = grouped.astype(np.int64) - previous
+    return np.cumsum(change)
+
+
+# Condition of each rule after every reading; the same hysteresis as
+# Rules.below and Rules.in_band
+def conditions(rules, grouping, values):
+    below = topic_flags(grouping, values < rules.limit - rules.hysteresis, values >= rules.limit, True)
+    in_band = topic_flags(grouping,
+                          (values >= rules.band_min) & (values <= rules.band_max),
+                          (values < rules.band_min - rules.hysteresis) | (values > rules.band_max + rules.hysteresis),
+                          False)
+    return {
+        'critical': flag_count(grouping, below) == 0,
+        'band': flag_count(grouping, in_band) == 0,
+    }
+
+
+# (raised, cleared) epoch ms of the intervals a debounced rule was raised,
+# and whether it is still raised at end; an open interval is cleared at end
+def rule_intervals(ts, condition, debounce, end):
+    if len(ts) == 0:
+        return np.empty(0, np.int64), np.empty(0, np.int64), False
+    changes = np.flatnonzero(condition[1:] != condition[:-1]) + 1
+    starts = np.concatenate(([0], changes))
+    run_start = ts[starts]
+    run_end = np.append(ts[changes], end)
+    run_value = condition[starts]
+    # A run shorter than the debounce never changes the state (nor does one
+    # that ends right at it: the reading ending it comes first); without
+    # debounce every run does. Of the rest only those that differ from the
+    # run before do.
+    lasting = run_end - run_start > debounce if debounce else np.ones(len(starts), bool)
+    run_start, run_value = run_start[lasting], run_value[lasting]
+    flips = run_value != np.concatenate(([False], run_value[:-1]))
+    flip_ts, flip_value = run_start[flips] + debounce, run_value[flips]
+    # Flips alternate, starting with a raise
+    raised = flip_ts[flip_value]
+    cleared = np.append(flip_ts[~flip_value], end)[:len(raised)]
+    return raised, cleared, bool(len(flip_value)) and bool(flip_value[-1])
+
+
+# Rules from a variant spec, e.g. "limit=54.5,debounce=30"
+def parse_variant(spec):
+    overrides = {}
+    for part in spec.split(','):
+        name, _, value = part.partition('=')
+        name = name.strip()
+        if name not in PARAMETERS:
+            raise ValueError(f"Unknown rule parameter '{name}' in '{spec}', expected one of {', '.join(PARAMETERS)}")
+        overrides[name] = float(value)
+    return alarms.Rules(**overrides)
+
+
+# One summary row per variant and rule, and all intervals
+def backtest(variants, ts, codes, values, start, end):
+    summary = []
+    intervals = []
+    span = max(end - start, 1)
+    grouping = topic_order(codes)
+    for label, rules in variants.items():
+        for rule, condition in conditions(rules, grouping, values).items():
+            raised, cleared, still_raised = rule_intervals(ts, condition, int(rules.debounce * 1000), end)
+            durations = cleared - raised
+            summary.append({
+                'variant': label,
+                'rule': rule,
+                'raised': len(raised),
+                'hours': durations.sum() / 3600000,
+                'share': durations.sum() / span,
+                'longest_min': durations.max() / 60000 if len(durations) else 0.0,
+                'raised_at_end': still_raised,
+            })
+            intervals.append(pd.DataFrame({'variant': label, 'rule': rule, 'raised': raised, 'cleared': cleared,
+                                           'minutes': durations / 60000}))
+    return pd.DataFrame(summary), pd.concat(intervals, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay stored readings through alarm rule variants')
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--archive', help='archive directory (default: next to the database)')
+    parser.add_argument('--start', default='0', help='epoch ms or ISO time, inclusive (default: the beginning)')
+    parser.add_argument('--end', help='epoch ms or ISO time, exclusive (default: now)')
+    parser.add_argument('--topic', action='append', help='topic name, repeatable (default: all topics)')
+    parser.add_argument('--variant', action='append', default=[],
+                        help=f"rule parameters to change, e.g. limit=54.5,debounce=30 ({', '.join(PARAMETERS)}); repeatable")
+    parser.add_argument('--intervals', help='write every raised interval to this CSV file')
+    args = parser.parse_args()
+
+    start = export.parse_time(args.start)
+    end = export.parse_time(args.end) if args.end else int(time.time() * 1000)
+    variants = {'current': alarms.Rules()}
+    try:
+        variants.update((spec, parse_variant(spec)) for spec in args.variant)
+    except ValueError as e:
+        sys.exit(str(e))
+    archive_dir = args.archive or os.path.join(os.path.dirname(os.path.abspath(args.db)), 'archive')
+    conn = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
+    conn.execute('PRAGMA busy_timeout=5000')
+
+    started = time.perf_counter()
+    ts, codes, values, names = load_readings(conn, archive_dir, start, end, args.topic)
+    loaded = time.perf_counter()
+    if len(ts):
+        # Nothing happens before the first reading
+        start = max(start, int(ts[0]))
+    summary, intervals = backtest(variants, ts, codes, values, start, end)
+    elapsed = time.perf_counter() - loaded
+    print(f'{len(ts)} readings of {len(names)} topics loaded in {loaded - started:.1f} s, '
+          f'{len(variants)} variants replayed in {elapsed:.2f} s', file=sys.stderr)
+
+    pd.set_option('display.width', 200)
+    print(summary.to_string(index=False, float_format=lambda x: f'{x:.2f}'))
+    if args.intervals:
+        intervals.assign(raised=pd.to_datetime(intervals['raised'], unit='ms', utc=True),
+                         cleared=pd.to_datetime(intervals['cleared'], unit='ms', utc=True)).to_csv(args.intervals, index=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+import alarms
+import archive
+
+# Streams the raw rows of a topic set and time range out of both tiers as CSV
+# or Parquet, in chunks of EXPORT_CHUNK rows, so memory stays flat however
+# many rows there are:
+#   python3 export.py --start 2025-05-01 --end 2025-06-01 --topic line1/T1 -o may.parquet
+#   python3 export.py --start 2025-05-01 --format csv > may.csv
+# The same export is served by the query service on /export.
+#
+# The archived days come first, file by file, then the rows still in SQLite in
+# (ts, id) order. Every SQLite chunk is a short read transaction of its own,
+# found from the last row of the previous one (keyset pagination), so the
+# export never keeps a snapshot open and the WAL can be checkpointed while it
+# runs. Rows the ingester archives while an export runs can be missed or
+# appear twice; a range entirely in one tier is not affected.
+DB_PATH = os.environ.get('DB_PATH', '/sqlite/data/temperatur.db')
+EXPORT_CHUNK = int(os.environ.get('EXPORT_CHUNK', '100000'))
+
+FORMATS = ('csv', 'parquet')
+
+
+# Epoch ms from epoch ms or an ISO date / time (UTC unless it says otherwise)
+def parse_time(text):
+    try:
+        return int(text)
+    except ValueError:
+        stamp = pd.Timestamp(text)
+        if stamp.tzinfo is None:
+            stamp = stamp.tz_localize('UTC')
+        return stamp.value // 1_000_000
+
+
+def cold_chunks(archive_dir, start, end, topics=None):
+    for path in archive.partition_files(archive_dir, start, end):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=EXPORT_CHUNK):
+            table = pa.Table.from_batches([batch]).cast(archive.SCHEMA)
+            keep = pc.and_(pc.greater_equal(table['ts'], start), pc.less(table['ts'], end))
+            if topics is not None:
+                keep = pc.and_(keep, pc.is_in(table['topic'], value_set=pa.array(list(topics), pa.string())))
+            # Alarm transitions archived before schema version 7 (see schema.py)
+            keep = pc.and_(keep, pc.invert(pc.is_in(table['topic'], value_set=pa.array(sorted(alarms.OWN_TOPICS), pa.string()))))
+            table = table.filter(keep)
+            if table.num_rows:
+                yield table
+
+
+def hot_chunks(conn, start, end, topics=None):
+    condition = ''
+    params = {'start': start, 'end': end, 'limit': EXPORT_CHUNK}
+    if topics is not None:
+        topics = list(topics)
+        condition = f"AND topic_id IN (SELECT id FROM topics WHERE name IN ({', '.join(f':topic{i}' for i in range(len(topics)))}))"
+        params.update({f'topic{i}': topic for i, topic in enumerate(topics)})
+    last_ts, last_id = start, -1
+    while True:
+        # The temp_ts index gives the rows in ts order; the row value
+        # comparison resumes right after the last row sent
+        rows = conn.execute(f'''
+            SELECT id, (SELECT name FROM topics WHERE topics.id = topic_id), value, message, ts FROM temp
+            WHERE ts >= :start AND ts < :end AND (ts, id) > (:last_ts, :last_id) {condition}
+            ORDER BY ts, id LIMIT :limit
+        ''', dict(params, last_ts=last_ts, last_id=last_id)).fetchall()
+        if not rows:
+            return
+        yield pa.Table.from_arrays([pa.array(column, type) for column, type in zip(zip(*rows), archive.SCHEMA.types)],
+                                   schema=archive.SCHEMA)
+        if len(rows) < EXPORT_CHUNK:
+            return
+        last_id, last_ts = rows[-1][0], rows[-1][4]
+
+
+# All chunks of the export, as tables with the archive's schema
+def chunks(conn, archive_dir, start, end, topics=None):
+    yield from cold_chunks(archive_dir, start, end, topics)
+    yield from hot_chunks(conn, start, end, topics)
+
+
+# Writes the chunks to out, a binary file object that only needs write();
+# returns the number of rows
+def write(out, tables, fmt):
+    rows = 0
+    sink = pa.PythonFile(out, mode='w')
+    if fmt == 'csv':
+        writer = pa_csv.CSVWriter(sink, archive.SCHEMA)
+    else:
+        writer = pq.ParquetWriter(sink, archive.SCHEMA, compression='zstd')
+    try:
+        for table in tables:
+            writer.write_table(table)
+            rows += table.num_rows
+    finally:
+        writer.close()
+        sink.flush()
+    return rows
+
+
+def export(conn, archive_dir, out, fmt, start, end, topics=None):
+    return write(out, chunks(conn, archive_dir, start, end, topics), fmt)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export raw readings as CSV or Parquet')
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--archive', help='archive directory (default: next to the database)')
+    parser.add_argument('--start', default='0', help='epoch ms or ISO time, inclusive (default: the beginning)')
+    parser.add_argument('--end', help='epoch ms or ISO time, exclusive (default: now)')
+    parser.add_argument('--topic', action='append', help='topic name, repeatable (default: all topics)')
+    parser.add_argument('--format', choices=FORMATS, help='default: from the output file name, else csv')
+    parser.add_argument('-o', '--output', help='output file (default: stdout)')
+    args = parser.parse_args()
+
+    fmt = args.format or ('parquet' if args.output and args.output.endswith('.parquet') else 'csv')
+    start = parse_time(args.start)
+    end = parse_time(args.end) if args.end else int(time.time() * 1000) + 1
+    archive_dir = args.archive or os.path.join(os.path.dirname(args.db), 'archive')
+    conn = sqlite3.connect(f'file:{args.db}?mode=ro', uri=True)
+    conn.execute('PRAGMA busy_timeout=5000')
+
+    started = time.perf_counter()
+    if args.output:
+        with open(args.output, 'wb') as out:
+            rows = export(conn, archive_dir, out, fmt, start, end, args.topic)
+    else:
+        rows = export(conn, archive_dir, sys.stdout.buffer, fmt, start, end, args.topic)
+    elapsed = time.perf_counter() - started
+    print(f'Exported {rows} rows in {elapsed:.1f} s ({rows / max(elapsed, 1e-9):.0f} rows/s)', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,608 @@
+import collections
+import multiprocessing
+import os
+import queue
+import signal
+import sqlite3
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import alarms
+import archive
+import latest
+import metrics
+import payloads
+import rollups
+import schema
+import spool
+import topic_stats
+import topics
+
+# Settings are read from the environment (see mqtt.yaml)
+DB_PATH = os.environ.get('DB_PATH', '/sqlite/data/temperatur.db')
+MQTT_BROKER_HOST = os.environ.get('MQTT_BROKER_HOST', 'localhost')
+MQTT_BROKER_PORT = int(os.environ.get('MQTT_BROKER_PORT', '1883'))
+MQTT_TOPIC = os.environ.get('MQTT_TOPIC', '#')
+
+# The subscription is a persistent session (clean_session=False) under this
+# client id, at QoS 1: while the ingester is down the broker keeps the
+# messages for it and delivers them when it reconnects
+MQTT_CLIENT_ID = os.environ.get('MQTT_CLIENT_ID', 'sqlite-ingester')
+MQTT_QOS = int(os.environ.get('MQTT_QOS', '1'))
+
+# A transaction is committed when it holds BATCH_SIZE messages or when
+# BATCH_INTERVAL seconds have passed since its first message, whichever comes first
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', '1000'))
+BATCH_INTERVAL = float(os.environ.get('BATCH_INTERVAL', '0.5'))
+
+# How often (seconds) the throughput line is written to the terminal
+STATS_INTERVAL = float(os.environ.get('STATS_INTERVAL', '10'))
+
+# Messages received but not yet committed; bounds memory if the disk stalls.
+# A structured payload (see payloads.py) counts as one message.
+QUEUE_SIZE = int(os.environ.get('QUEUE_SIZE', '100000'))
+
+# Messages that do not fit in the queue go to this append-only file (see
+# spool.py) instead of holding up the MQTT network thread
+SPOOL_PATH = os.environ.get('SPOOL_PATH', os.path.join(os.path.dirname(DB_PATH), 'spool.jsonl'))
+
+# Upper bound on the rows of one transaction while working off a backlog
+# (the spool, or a queue that filled up during an outage or a lock wait)
+REPLAY_BATCH_SIZE = int(os.environ.get('REPLAY_BATCH_SIZE', '50000'))
+
+# Port of the Prometheus /metrics endpoint, 0 to disable
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9100'))
+
+# Number of processes receiving messages. With more than one, the workers
+# share one MQTT subscription ($share/MQTT_CLIENT_ID/MQTT_TOPIC), so the
+# broker hands every message to one of them; each parses and aggregates its
+# share (see summarize) and hands it in chunks to a single writer process
+# that owns the SQLite connection
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', '1'))
+
+# How often (seconds) a worker hands its messages to the writer
+CHUNK_INTERVAL = float(os.environ.get('CHUNK_INTERVAL', '0.05'))
+
+# At most one "Stored message" line per LOG_INTERVAL seconds
+LOG_INTERVAL = float(os.environ.get('LOG_INTERVAL', '10'))
+
+# How often (seconds) the rolling statistics of all topics are rewritten, so
+# the windows of topics that went silent empty out (see topic_stats.py)
+STATS_REFRESH = float(os.environ.get('STATS_REFRESH', '60'))
+
+# How often (seconds) rows older than RETENTION_DAYS are looked for (see archive.py)
+ARCHIVE_INTERVAL = float(os.environ.get('ARCHIVE_INTERVAL', '3600'))
+
+MESSAGES = metrics.Counter('ingest_messages_total', 'Messages stored')
+TOPIC_MESSAGES = metrics.Counter('ingest_topic_messages_total', 'Messages stored per topic', label='topic')
+MESSAGE_RATE = metrics.Gauge('ingest_messages_per_second', 'Messages stored per second over the last stats interval')
+QUEUE_DEPTH = metrics.Gauge('ingest_queue_depth', 'Messages received but not yet committed')
+BATCH_SIZES = metrics.Histogram('ingest_batch_size', 'Messages per committed transaction',
+                                buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+COMMIT_SECONDS = metrics.Histogram('ingest_commit_seconds', 'Time to write and commit one batch')
+LAG_SECONDS = metrics.Histogram('ingest_lag_seconds', 'Time from a message being received to its commit (oldest message of each batch)')
+SPOOL_BACKLOG = metrics.Gauge('ingest_spool_backlog_bytes', 'Bytes in the spool not yet written to the database')
+SPOOLED = metrics.Counter('ingest_spooled_messages_total', 'Messages that went to the spool because the queue was full')
+REPLAYED = metrics.Counter('ingest_replayed_rows_total', 'Rows read back from the spool')
+CATCHUP_RATE = metrics.Gauge('ingest_catchup_rows_per_second', 'Rows per second of the last completed catch-up')
+READINGS_PER_MESSAGE = metrics.Histogram('ingest_readings_per_message', 'Readings decoded from one message',
+                                         buckets=(1, 2, 5, 10, 50, 100, 500, 1000))
+
+
+def open_database(path):
+    conn = sqlite3.connect(path)
+    # WAL lets the dashboard read while we write, and NORMAL sync only
+    # fsyncs at checkpoints instead of on every commit
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=5000')
+    # Create the schema, or upgrade an older database in place
+    for version in schema.ensure_schema(conn):
+        print(f"Database schema upgraded to version {version}", flush=True)
+    return conn
+
+
+# userdata is the topic filter to subscribe to, MQTT_TOPIC when None
+def on_connect(client, userdata, flags, rc):
+    if rc == 0:
+        # With a session present the broker already has our subscription and
+        # is sending what it queued while we were away
+        topic = userdata or MQTT_TOPIC
+        session = 'resuming session' if flags.get('session present') else 'new session'
+        print(f"Connected to {MQTT_BROKER_HOST}:{MQTT_BROKER_PORT} ({session}), subscribing to '{topic}'", flush=True)
+        client.subscribe(topic, qos=MQTT_QOS)
+    else:
+        print(f"Connection to broker refused (rc={rc})", flush=True)
+
+
+# (topic, value, message, ts) rows of a message received at received (epoch
+# ms); a structured payload carries many readings with their own timestamps
+def message_rows(msg, received):
+    rows = payloads.decode(msg.topic, msg.payload, received)
+    READINGS_PER_MESSAGE.observe(len(rows))
+    return rows
+
+
+# Errors of a row that cannot be bound, e.g. an integer beyond 64 bits
+# (OverflowError) or a value of another type (InterfaceError before Python
+# 3.12, ProgrammingError since)
+ROW_ERRORS = (OverflowError, sqlite3.InterfaceError, sqlite3.ProgrammingError)
+
+
+# False for a (topic, value, message, ts) row SQLite cannot take
+def storable(conn, row):
+    try:
+        conn.execute('SELECT ?, ?, ?, ?', row)
+    except ROW_ERRORS:
+        return False
+    return True
+
+
+# Per-topic aggregates of (topic, value, message, ts) rows, keyed by topic
+# name: the rollup buckets, the newest reading and the statistics. The
+# workers of the sharded mode send them along with their chunks, so the
+# writer only merges a few entries per topic instead of folding in every row.
+def summarize(rows):
+    stats = topic_stats.TopicStats()
+    stats.update(rows)
+    return rollups.aggregate(rows), latest.newest(rows), stats.partial()
+
+
+class Ingester:
+    # spool is an optional spool.Spool for the messages that do not fit in
+    # the queue; without one, on_message waits for room
+    def __init__(self, conn, spool=None):
+        self.conn = conn
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.stored = 0
+        self.batches = 0
+        self.next_archive = 0
+        self.running = True
+        self.log = metrics.SampledLog(LOG_INTERVAL)
+        self.topics = topics.TopicRegistry()
+        self.alarms = alarms.AlarmEngine()
+        self.alarms.restore(conn)
+        self.stats = topic_stats.TopicStats()
+        self.stats.restore(conn)
+        # Changes when another connection commits (backfill.py, archive.py)
+        self.data_version = self.read_data_version()
+        self.next_stats = 0
+        self.spool = spool
+        # summarize() of the chunks in the batch being built (sharded mode);
+        # without them the batch is aggregated from its rows
+        self.summaries = []
+        # Spool offset to commit once the current batch is written
+        self.spool_offset = None
+        # True when the current batch works off a backlog; catchup holds the
+        # start time and rows of the backlog being worked off
+        self.behind = False
+        self.catchup = None
+        QUEUE_DEPTH.function = self.queue.qsize
+        if spool is not None:
+            SPOOL_BACKLOG.function = spool.backlog
+
+    # Called from the MQTT network thread - only decode and hand the rows over
+    def on_message(self, client, userdata, msg):
+        if alarms.own_topic(msg.topic):
+            return
+        received = int(time.time() * 1000)
+        rows = message_rows(msg, received)
+        # Alarms are evaluated here, before the batch is written, so a
+        # transition is published within milliseconds of the reading
+        self.alarms.process_rows(rows, received)
+        self.enqueue((received, rows))
+
+    # Once a message has gone to the spool, the following ones do too until
+    # the writer has read it back, so the arrival order is kept
+    def enqueue(self, message):
+        if self.spool is None:
+            self.queue.put(message)
+            return
+        if not self.spool.pending():
+            try:
+                self.queue.put_nowait(message)
+                return
+            except queue.Full:
+                pass
+        self.spool.append([message])
+        SPOOLED.inc()
+
+    # (received, rows) of the messages that arrived within timeout seconds,
+    # received being when the first of them came in; raises queue.Empty if
+    # none did
+    def take(self, timeout):
+        return self.queue.get(timeout=timeout)
+
+    # Collect messages until the batch is full or BATCH_INTERVAL has passed.
+    # The rows of one message always go into the same batch. Returns an empty
+    # batch after a second without messages so maintenance still runs when
+    # the line is idle.
+    def next_batch(self):
+        self.spool_offset = None
+        self.behind = False
+        # Spooled messages are newer than the queued ones
+        if self.spool is not None and self.spool.pending() and self.queue.empty():
+            messages, self.spool_offset = self.spool.read(REPLAY_BATCH_SIZE)
+            if messages:
+                self.behind = True
+                batch = [row for _received, rows in messages for row in rows]
+                REPLAYED.inc(len(batch))
+                return messages[0][0], batch
+            self.spool_offset = None
+        try:
+            received, batch = self.take(1)
+        except queue.Empty:
+            return None, []
+        # With a backlog in the spool, new messages go there rather than to
+        # the queue, so there is nothing to wait for
+        self.behind = self.spool is not None and self.spool.pending()
+        deadline = time.monotonic() + (0 if self.behind else BATCH_INTERVAL)
+        while len(batch) < BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.extend(self.take(remaining)[1])
+            except queue.Empty:
+                break
+        # More is already waiting: this is a backlog (an outage, a lock
+        # wait), so drain it in a few large transactions instead of many
+        # small ones
+        while len(batch) < REPLAY_BATCH_SIZE:
+            try:
+                batch.extend(self.take(0)[1])
+            except queue.Empty:
+                break
+            self.behind = True
+        return received, batch
+
+    def read_data_version(self):
+        return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    # Starts a write transaction. The in-memory statistics are rewritten to
+    # topic_stats with every batch, so when another connection has written
+    # since our last commit they are reloaded first; holding the write lock,
+    # nothing can slip in between.
+    def begin(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        data_version = self.read_data_version()
+        if data_version != self.data_version:
+            self.stats = topic_stats.TopicStats()
+            self.stats.restore(self.conn)
+            self.data_version = data_version
+
+    # Nothing of the batch was committed: forget the topic ids it registered
+    # and its readings in the statistics, and keep its transitions for the
+    # retry
+    def forget_batch(self, events):
+        self.topics = topics.TopicRegistry()
+        self.stats = topic_stats.TopicStats()
+        self.stats.restore(self.conn)
+        self.alarms.return_events(events)
+
+    # received is when the batch's first message came in (epoch ms); without
+    # it the lag is measured from the oldest reading
+    def write_batch(self, batch, received=None):
+        if not batch:
+            return
+        events = self.alarms.take_events()
+        try:
+            with COMMIT_SECONDS.time():
+                with self.conn:
+                    self.begin()
+                    rows = self.topics.encode(self.conn, batch)
+                    self.conn.executemany('INSERT INTO temp (topic_id, value, message, ts) VALUES (?, ?, ?, ?)', rows)
+                    self.store_aggregates(rows)
+                    alarms.store_events(self.conn, events)
+        except ROW_ERRORS as e:
+            # A row SQLite cannot take: rather than losing the batch (or
+            # failing on it again after a restart, when it came from the
+            # spool), it is written again without the rows that fail
+            self.forget_batch(events)
+            kept = [row for row in batch if storable(self.conn, row)]
+            if len(kept) == len(batch):
+                raise
+            print(f"Dropped {len(batch) - len(kept)} rows that cannot be stored: {e}", flush=True)
+            # The summaries count the dropped rows too
+            self.summaries = []
+            return self.write_batch(kept, received)
+        except sqlite3.Error:
+            self.forget_batch(events)
+            raise
+        if received is None:
+            received = min(row[3] for row in batch)
+        LAG_SECONDS.observe(max(0, time.time() - received / 1000))
+        BATCH_SIZES.observe(len(batch))
+        MESSAGES.inc(len(batch))
+        for topic, count in collections.Counter(row[0] for row in batch).items():
+            TOPIC_MESSAGES.inc(count, topic)
+        self.stored += len(batch)
+        self.batches += 1
+        self.summaries = []
+
+        topic, value, message, _ts = batch[-1]
+        self.log(f"Stored message from topic {topic}: {message if value is None else value}", len(batch))
+
+    # Folds the batch's (topic_id, value, message, ts) rows into the rollups,
+    # temp_latest and topic_stats, from the chunks' summaries when there are
+    def store_aggregates(self, rows):
+        if not self.summaries:
+            rollups.update_rollups(self.conn, rows)
+            latest.update_latest(self.conn, rows)
+            self.stats.store(self.conn, self.stats.update(rows))
+            return
+        ids = self.topics.ids
+        newest = {}
+        touched = set()
+        for table in rollups.ROLLUPS:
+            rollups.merge_buckets(self.conn, table, [(bucket, ids[topic], count, total, low, high)
+                                                     for buckets, _newest, _stats in self.summaries
+                                                     for bucket, topic, count, total, low, high in buckets[table]])
+        for _buckets, chunk_newest, stats in self.summaries:
+            for topic, (value, ts) in chunk_newest.items():
+                current = newest.get(ids[topic])
+                if current is None or ts >= current[1]:
+                    newest[ids[topic]] = (value, ts)
+            touched |= self.stats.merge(stats, ids)
+        latest.write_latest(self.conn, newest)
+        self.stats.store(self.conn, touched)
+
+    # Housekeeping between two batches. The ingester owns the only writing
+    # connection, so resets and archiving never have to wait for its lock.
+    def maintenance(self):
+        if os.path.exists(archive.RESET_REQUEST):
+            archive.reset(self.conn, archive.ARCHIVE_DIR)
+            os.remove(archive.RESET_REQUEST)
+            # Forget the topic ids, statistics and per-topic alarm state along
+            # with the data. Raised rules are cleared, stored below and
+            # published again, so alarm_events and the retained topics do not
+            # keep showing an alarm about data that is gone.
+            self.topics = topics.TopicRegistry()
+            self.stats = topic_stats.TopicStats()
+            self.alarms.clear()
+            print("Database reset on request", flush=True)
+
+        # Complete debounced transitions even when no readings arrive
+        self.alarms.tick()
+        events = self.alarms.take_events()
+        if events:
+            try:
+                with self.conn:
+                    alarms.store_events(self.conn, events)
+            except sqlite3.Error:
+                self.alarms.return_events(events)
+                raise
+
+        if time.monotonic() >= self.next_stats:
+            with self.conn:
+                self.begin()
+                self.stats.store(self.conn)
+            self.next_stats = time.monotonic() + STATS_REFRESH
+
+        # Archive one chunk per batch until the backlog is gone, then wait
+        if time.monotonic() >= self.next_archive:
+            moved = archive.archive_chunk(self.conn, archive.ARCHIVE_DIR, archive.retention_cutoff())
+            if moved:
+                print(f"Archived {moved} rows to {archive.ARCHIVE_DIR}", flush=True)
+            else:
+                self.next_archive = time.monotonic() + ARCHIVE_INTERVAL
+
+    # Reports the throughput of a catch-up, from the first batch working off
+    # a backlog to the first regular batch after it
+    def track_catchup(self, rows, started):
+        if self.behind:
+            if self.catchup is None:
+                self.catchup = [started, 0]
+            self.catchup[1] += rows
+        elif self.catchup is not None:
+            started, caught_up = self.catchup
+            elapsed = max(time.monotonic() - started, 1e-9)
+            CATCHUP_RATE.set(caught_up / elapsed)
+            print(f"Caught up on {caught_up} rows in {elapsed:.1f} s ({caught_up / elapsed:.0f} rows/s)", flush=True)
+            self.catchup = None
+
+    # Makes run() return after the batch in progress
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        last_report = time.monotonic()
+        last_stored = 0
+        received, batch = None, []
+        while self.running:
+            if not batch:
+                received, batch = self.next_batch()
+            started = time.monotonic()
+            try:
+                self.write_batch(batch, received)
+                if self.spool_offset is not None:
+                    self.spool.commit(self.spool_offset)
+                self.track_catchup(len(batch), started)
+                batch = []
+                self.maintenance()
+            except sqlite3.OperationalError as e:
+                # E.g. another connection holding the write lock for longer
+                # than busy_timeout. A batch that failed is kept and written on
+                # the next pass; new messages wait in the queue and the spool.
+                print(f"Database busy, retrying: {e}", flush=True)
+                time.sleep(1)
+
+            now = time.monotonic()
+            if now - last_report >= STATS_INTERVAL:
+                rate = (self.stored - last_stored) / (now - last_report)
+                MESSAGE_RATE.set(rate)
+                spooled = f", spool {self.spool.backlog()} bytes" if self.spool is not None else ''
+                print(f"Stored {self.stored} messages in {self.batches} batches "
+                      f"({rate:.1f} msg/s, queue {self.queue.qsize()}{spooled})", flush=True)
+                last_report = now
+                last_stored = self.stored
+
+    # Writes what is still queued in memory, after the MQTT client has
+    # stopped; the spool keeps its backlog for the next start
+    def flush(self):
+        messages = []
+        while True:
+            try:
+                messages.append(self.take(0))
+            except queue.Empty:
+                break
+        if messages:
+            self.write_batch([row for _received, rows in messages for row in rows], messages[0][0])
+
+
+# Writer side of the sharded mode (INGEST_WORKERS > 1). Messages arrive in
+# chunks from the workers; a queue delivers each worker's chunks in the order
+# they were sent, but a topic's readings can come through different workers,
+# so they are not always in order. Only the alarm engine depends on the order,
+# and it skips readings older than a topic's newest.
+class ShardedIngester(Ingester):
+    def __init__(self, conn, chunks, workers):
+        super().__init__(conn)
+        self.queue = chunks
+        self.workers = workers
+        QUEUE_DEPTH.function = chunks.qsize
+
+    # The alarm engine needs every topic and the order of the readings, so it
+    # runs here rather than in the workers, on the writer's clock like tick()
+    def take(self, timeout):
+        received, rows, summary = self.queue.get(timeout=timeout)
+        self.summaries.append(summary)
+        self.alarms.process_rows(rows, int(time.time() * 1000))
+        return received, rows
+
+    def maintenance(self):
+        # A dead worker would silently drop its share; exit and let the
+        # container restart instead
+        for worker in self.workers:
+            if not worker.is_alive():
+                raise SystemExit(f"Worker {worker.name} exited with code {worker.exitcode}")
+        super().maintenance()
+
+
+# One receiving process of the sharded mode. The workers share one
+# subscription, so each receives, parses and acknowledges only the messages
+# the broker hands to it, and the broker queues every message once for all
+# of them. Each has its own persistent session; while a worker is down the
+# broker keeps its share for it. When the writer's queue is full, a worker's
+# chunks go to its own spool.
+class Worker:
+    def __init__(self, index, chunks):
+        self.index = index
+        self.chunks = chunks
+        self.spool = spool.Spool(f'{SPOOL_PATH}.{index}')
+        # (received, rows) per message not yet handed to the writer
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def on_message(self, client, userdata, msg):
+        if alarms.own_topic(msg.topic):
+            return
+        received = int(time.time() * 1000)
+        rows = message_rows(msg, received)
+        with self.lock:
+            self.pending.append((received, rows))
+
+    # (received, rows) chunks of about BATCH_SIZE rows, so the bounded queue
+    # also bounds the rows waiting for the writer. A message is never split
+    # over two chunks.
+    @staticmethod
+    def chunks_of(pending):
+        chunk_received, chunk = None, []
+        for received, rows in pending:
+            if chunk and len(chunk) + len(rows) > BATCH_SIZE:
+                yield chunk_received, chunk
+                chunk_received, chunk = None, []
+            if chunk_received is None:
+                chunk_received = received
+            chunk.extend(rows)
+        if chunk:
+            yield chunk_received, chunk
+
+    # Hands messages to the writer. The spool is read back first whenever
+    # the queue has room again, so this worker's messages stay in order. A chunk
+    # counts as written once it is in the queue.
+    def hand_over(self, pending):
+        while self.spool.pending():
+            messages, offset = self.spool.read(BATCH_SIZE)
+            if not messages:
+                break
+            try:
+                rows = [row for _received, rows in messages for row in rows]
+                self.chunks.put_nowait((messages[0][0], rows, summarize(rows)))
+            except queue.Full:
+                break
+            self.spool.commit(offset)
+        chunks = list(self.chunks_of(pending))
+        for index, chunk in enumerate(chunks):
+            if not self.spool.pending():
+                try:
+                    self.chunks.put_nowait(chunk + (summarize(chunk[1]),))
+                    continue
+                except queue.Full:
+                    pass
+            self.spool.append(chunks[index:])
+            SPOOLED.inc(len(chunks) - index)
+            break
+
+    def run(self):
+        client = mqtt.Client(client_id=f'{MQTT_CLIENT_ID}-{self.index}', clean_session=False,
+                             userdata=f'$share/{MQTT_CLIENT_ID}/{MQTT_TOPIC}')
+        client.on_connect = on_connect
+        client.on_message = self.on_message
+        client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT)
+        client.loop_start()
+        self.forward()
+
+    # Hands the received messages over every CHUNK_INTERVAL, for good
+    def forward(self):
+        while True:
+            time.sleep(CHUNK_INTERVAL)
+            with self.lock:
+                pending, self.pending = self.pending, []
+            self.hand_over(pending)
+
+
+def run_worker(index, chunks):
+    Worker(index, chunks).run()
+
+
+def main():
+    if INGEST_WORKERS > 1:
+        # Workers are started before the writer opens the database or starts
+        # any threads, so nothing of it is inherited by the fork
+        chunks = multiprocessing.Queue(maxsize=max(1, QUEUE_SIZE // BATCH_SIZE))
+        workers = [multiprocessing.Process(target=run_worker, args=(index, chunks),
+                                           name=f'worker-{index}', daemon=True)
+                   for index in range(INGEST_WORKERS)]
+        for worker in workers:
+            worker.start()
+        print(f"Started {INGEST_WORKERS} ingest workers", flush=True)
+        ingester = ShardedIngester(open_database(DB_PATH), chunks, workers)
+        # This client only publishes alarm transitions
+        client = mqtt.Client()
+    else:
+        ingester = Ingester(open_database(DB_PATH), spool.Spool(SPOOL_PATH))
+        client = mqtt.Client(client_id=MQTT_CLIENT_ID, clean_session=False)
+        client.on_connect = on_connect
+        client.on_message = ingester.on_message
+    if METRICS_PORT:
+        metrics.start_server(METRICS_PORT)
+
+    ingester.alarms.publish = alarms.mqtt_publisher(client)
+    client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT)
+    # docker stop: finish the batch in progress, stop receiving (the broker
+    # queues for the session from then on) and write what is left in memory
+    signal.signal(signal.SIGTERM, lambda signum, frame: ingester.stop())
+    # The network loop runs in its own thread, the main thread writes to SQLite
+    client.loop_start()
+    ingester.run()
+    client.disconnect()
+    client.loop_stop()
+    ingester.flush()
+    print("Ingester stopped", flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,86 @@
+-- Canonical schema for temperatur.db. Existing databases are upgraded by
+-- migrate.py, see schema.py for the version history.
+
+-- Every topic name is stored once; the tables below refer to it by id
+CREATE TABLE IF NOT EXISTS topics (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+-- One row per reading. value holds the reading when the payload is a number,
+-- message holds the raw payload only when it is not. ts is milliseconds since
+-- the Unix epoch (UTC).
 CREATE TABLE IF NOT EXISTS temp (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
-    topic TEXT NOT NULL,
-    message REAL NOT NULL,
-    logget_tid DATETIME DEFAULT CURRENT_TIMESTAMP
+    topic_id INTEGER NOT NULL REFERENCES topics (id),
+    value REAL,
+    message TEXT,
+    ts INTEGER NOT NULL
+);
+
+-- Covering indexes: per-topic time ranges and all-topic time ranges can be
+-- answered from the index alone without touching the table
+CREATE INDEX IF NOT EXISTS temp_topic_ts ON temp (topic_id, ts, value);
+CREATE INDEX IF NOT EXISTS temp_ts ON temp (ts, topic_id, value);
+
+-- Per-topic rollups of the numeric readings, maintained by the ingester in
+-- the same transaction as the raw rows. bucket is the start of the interval
+-- in epoch ms; the mean is sum / count. Keyed by bucket first so a time range
+-- over all topics is a single range scan.
+CREATE TABLE IF NOT EXISTS temp_1m (
+    bucket INTEGER NOT NULL,
+    topic_id INTEGER NOT NULL REFERENCES topics (id),
+    count INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    PRIMARY KEY (bucket, topic_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS temp_1h (
+    bucket INTEGER NOT NULL,
+    topic_id INTEGER NOT NULL REFERENCES topics (id),
+    count INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    PRIMARY KEY (bucket, topic_id)
+) WITHOUT ROWID;
+
+-- Latest numeric reading per topic, upserted by the ingester with every
+-- batch. Drives the alarm panel without scanning raw rows.
+CREATE TABLE IF NOT EXISTS temp_latest (
+    topic_id INTEGER PRIMARY KEY REFERENCES topics (id),
+    value REAL NOT NULL,
+    ts INTEGER NOT NULL
+);
+
+-- Rolling statistics per topic over the windows of topic_stats.py ('5m',
+-- '1h', '24h', ...) and over all readings ('all'). Written by the ingester in
+-- the same transaction as the rows of the topic, and for every topic once a
+-- minute so windows of silent topics empty out. rate is the change per
+-- minute; updated is when the row was computed (epoch ms).
+CREATE TABLE IF NOT EXISTS topic_stats (
+    topic_id INTEGER NOT NULL REFERENCES topics (id),
+    span TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    min REAL,
+    max REAL,
+    mean REAL,
+    std REAL,
+    rate REAL,
+    last_ts INTEGER,
+    updated INTEGER NOT NULL,
+    PRIMARY KEY (topic_id, span)
+) WITHOUT ROWID;
+
+-- Alarm state transitions from the ingester's alarm engine (see alarms.py)
+CREATE TABLE IF NOT EXISTS alarm_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    rule TEXT NOT NULL,
+    state TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    topic TEXT,
+    value REAL,
+    message TEXT
 );
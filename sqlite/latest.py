@@ -0,0 +1,39 @@
+# Keeps temp_latest (see init.sql) at the newest numeric reading per topic.
+# Only one row per topic in the batch is written, and an older reading never
+# replaces a newer one.
+def update_latest(conn, rows):
+    write_latest(conn, newest(rows))
+
+
+# topic -> (value, ts) of the newest numeric reading per topic of the rows.
+# topic is the rows' first field: a topic id, or a name in the workers of the
+# sharded ingester.
+def newest(rows):
+    latest = {}
+    for topic, value, _message, ts in rows:
+        if value is None:
+            continue
+        current = latest.get(topic)
+        if current is None or ts >= current[1]:
+            latest[topic] = (value, ts)
+    return latest
+
+
+# Writes topic_id -> (value, ts) where it is newer than what is stored
+def write_latest(conn, latest):
+    if latest:
+        conn.executemany('''
+            INSERT INTO temp_latest (topic_id, value, ts) VALUES (?, ?, ?)
+            ON CONFLICT (topic_id) DO UPDATE SET value = excluded.value, ts = excluded.ts
+            WHERE excluded.ts >= temp_latest.ts
+        ''', [(topic_id, value, ts) for topic_id, (value, ts) in latest.items()])
+
+
+# Rebuilds temp_latest from the raw rows. SQLite takes the bare value column
+# from the row holding max(ts).
+def rebuild_latest(conn):
+    conn.execute('DELETE FROM temp_latest')
+    conn.execute('''
+        INSERT INTO temp_latest (topic_id, value, ts)
+        SELECT topic_id, value, max(ts) FROM temp WHERE value IS NOT NULL GROUP BY topic_id
+    ''')
@@ -0,0 +1,31 @@
+import os
+import sqlite3
+import sys
+
+import schema
+
+# Upgrades temperatur.db in place to the current schema (see schema.py).
+# The ingester does this on start-up as well; run it by hand to upgrade a
+# copied database or to check what would happen:
+#   python3 migrate.py /sqlite/data/temperatur.db
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else os.environ.get('DB_PATH', '/sqlite/data/temperatur.db')
+    if not os.path.exists(path):
+        sys.exit(f'No database at {path}')
+
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA busy_timeout=30000')
+    before = schema.schema_version(conn)
+    applied = schema.ensure_schema(conn)
+    if applied:
+        rows = conn.execute('SELECT count(*) FROM temp').fetchone()[0]
+        print(f'Upgraded {path} from version {before} to {applied[-1]} ({rows} rows)')
+    else:
+        print(f'{path} is already at version {before}')
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
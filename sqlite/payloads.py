@@ -0,0 +1,110 @@
+import json
+import math
+import os
+import struct
+
+import schema
+
+# Turns an MQTT payload into (topic, value, message, ts) rows. A payload is
+# one of:
+#   a scalar   "58.3" - one reading, stamped with the time it was received
+#   JSON       one or many readings with the device's own timestamps:
+#                {"ts": 1718000000000, "value": 58.3}
+#                {"ts": 1718000000000, "channels": {"T1": 58.3, "T2": 59.1}}
+#                [[1718000000000, 58.3], [1718000001000, 58.4], ...]
+#                [{"ts": ..., "value": ...}, {"ts": ..., "channels": {...}}, ...]
+#              A channel is stored as its own topic, <topic>/<channel>.
+#   binary     BINARY_MAGIC followed by little-endian (int64 ts, float64
+#              value) records, 16 bytes per reading
+# ts is epoch milliseconds; a reading without one gets the receive time.
+# Anything else, including JSON of another shape, is stored as a message
+# like before.
+
+BINARY_MAGIC = b'\x00TB1'
+BINARY_RECORD = struct.Struct('<qd')
+
+# Device timestamps further ahead of the receive time than this (seconds)
+# are replaced by it; a clock running ahead would otherwise hold the latest
+# reading of its topic for good (see latest.py). So are timestamps before
+# 1970, which also keeps every ts within SQLite's 64-bit integers.
+MAX_CLOCK_SKEW = float(os.environ.get('MAX_CLOCK_SKEW', '300'))
+
+
+# Epoch ms of a reading: the device's timestamp when it has a sane one
+def reading_ts(ts, received):
+    if isinstance(ts, bool) or not isinstance(ts, (int, float)):
+        return received
+    try:
+        ts = int(ts)
+    except (OverflowError, ValueError):
+        # inf or nan
+        return received
+    return ts if 0 <= ts <= received + MAX_CLOCK_SKEW * 1000 else received
+
+
+# Numbers and numeric strings are values; anything else is kept as text
+def reading_row(topic, value, ts, received):
+    number = None if isinstance(value, bool) else schema.parse_value(value)
+    message = None
+    if number is None:
+        message = value if isinstance(value, str) else json.dumps(value)
+    return (topic, number, message, reading_ts(ts, received))
+
+
+# Rows of one JSON reading object, or None if it is not one
+def object_rows(topic, reading, received):
+    if 'channels' in reading and isinstance(reading['channels'], dict):
+        ts = reading.get('ts')
+        return [reading_row(f'{topic}/{channel}', value, ts, received) for channel, value in reading['channels'].items()]
+    if 'value' in reading:
+        return [reading_row(topic, reading['value'], reading.get('ts'), received)]
+    return None
+
+
+def json_rows(topic, document, received):
+    if isinstance(document, dict):
+        return object_rows(topic, document, received)
+    if not isinstance(document, list) or not document:
+        return None
+    rows = []
+    for reading in document:
+        if isinstance(reading, list) and len(reading) == 2:
+            rows.append(reading_row(topic, reading[1], reading[0], received))
+        elif isinstance(reading, dict):
+            readings = object_rows(topic, reading, received)
+            if readings is None:
+                return None
+            rows += readings
+        else:
+            return None
+    return rows
+
+
+def binary_rows(topic, payload, received):
+    body = memoryview(payload)[len(BINARY_MAGIC):]
+    if len(body) % BINARY_RECORD.size:
+        return None
+    limit = received + int(MAX_CLOCK_SKEW * 1000)
+    return [(topic, value if math.isfinite(value) else None, None if math.isfinite(value) else repr(value),
+             ts if 0 <= ts <= limit else received)
+            for ts, value in BINARY_RECORD.iter_unpack(body)]
+
+
+# All rows of a payload received at received (epoch ms). The raw payload is
+# only kept when it is not a number.
+def decode(topic, payload, received):
+    rows = None
+    if payload.startswith(BINARY_MAGIC):
+        rows = binary_rows(topic, payload, received)
+        if rows is None:
+            return [(topic, None, f'Malformed binary payload ({len(payload)} bytes)', received)]
+    elif payload[:1] in (b'{', b'['):
+        try:
+            rows = json_rows(topic, json.loads(payload), received)
+        except ValueError:
+            rows = None
+    if rows is not None:
+        return rows
+    message = payload.decode('utf-8', errors='replace')
+    value = schema.parse_value(message)
+    return [(topic, value, None if value is not None else message, received)]
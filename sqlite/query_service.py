@@ -0,0 +1,446 @@
+import collections
+import hmac
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+import pyarrow as pa
+
+import alarms
+import archive
+import export
+import metrics
+import rollups
+
+# Read-only HTTP access to temperatur.db, so the dashboard and other tools
+# never open the SQLite file themselves:
+#   GET  /version  data version and id range; changes whenever the ingester commits
+#   GET  /topics   the topic registry (id, name)
+#   GET  /latest   newest reading per topic
+#   GET  /stats    rolling statistics per topic and window (see topic_stats.py)
+#   GET  /events   recent alarm transitions (?limit=20)
+#   GET  /alarms   the alarm engine's rules and the last transition of each rule
+#   GET  /series   raw rows or 1m / 1h aggregates for a topic set and time range
+#   GET  /export   raw rows of a topic set and time range as a CSV or Parquet
+#                  download, streamed from both tiers (see export.py)
+#   POST /reset    asks the ingester to clear all data (see archive.py); needs
+#                  the X-Reset-Token header to equal RESET_TOKEN
+#   GET  /metrics  Prometheus metrics
+#
+# /latest, /stats and /series take these parameters:
+#   topic=<name>, topic_id=<id>  repeatable; all topics when neither is given
+#   resolution=raw|1m|1h         default raw
+#   start, end                   epoch ms, or span=<ms> for the last span ms
+#   after=<cursor>               only data newer than the cursor of an earlier
+#                                response (X-Cursor header / "cursor" field)
+#   limit=<n>                    raw rows: the newest n
+#   format=json|arrow            json is column-oriented; arrow is an IPC stream
+#
+# /export takes topic, topic_id, start, end and span like /series, and
+# format=csv|parquet (default csv). It is never cached and has no row limit;
+# start defaults to the beginning.
+#
+# Raw rows come from SQLite and the Parquet archive; with after they are the
+# rows SQLite got since the cursor (by id), the newest of them by time.
+# Aggregates have the bucket start as ts; their cursor is the newest bucket,
+# which is sent again because it may still be filling up.
+#
+# Responses are cached, keyed by the request and the data version, so
+# repeated requests between two commits are answered from memory.
+DB_PATH = os.environ.get('DB_PATH', '/sqlite/data/temperatur.db')
+QUERY_PORT = int(os.environ.get('QUERY_PORT', '8080'))
+CACHE_ENTRIES = int(os.environ.get('CACHE_ENTRIES', '256'))
+
+# Shared secret for POST /reset. The port is published for the browser's
+# export downloads, so anyone reaching it could otherwise wipe the data;
+# without a token the endpoint is disabled.
+RESET_TOKEN = os.environ.get('RESET_TOKEN', '')
+
+# Span used for raw rows when neither start nor after is given
+DEFAULT_SPAN = 60 * 60 * 1000
+
+# Upper bound on the raw rows of one response
+MAX_ROWS = int(os.environ.get('MAX_ROWS', '1000000'))
+
+# Resolution parameter -> rollup table (see rollups.py)
+ROLLUP_TABLES = {
+    '1m': 'temp_1m',
+    '1h': 'temp_1h',
+}
+
+PATHS = ('/version', '/topics', '/latest', '/stats', '/events', '/alarms', '/series', '/export', '/reset', '/metrics')
+
+REQUESTS = metrics.Counter('query_requests_total', 'Requests per endpoint', label='path')
+CACHE_HITS = metrics.Counter('query_cache_hits_total', 'Requests answered from the response cache')
+REQUEST_SECONDS = metrics.Histogram('query_request_seconds', 'Time to answer a request')
+
+
+class BadRequest(Exception):
+    pass
+
+
+# SQL condition limiting a query to topic_ids (None = all topics). The ids
+# are validated integers, so they are inlined.
+def topic_condition(topic_ids):
+    if topic_ids is None:
+        return '1'
+    return f"topic_id IN ({', '.join(str(int(topic_id)) for topic_id in topic_ids)})"
+
+
+def int_param(params, name, default=None):
+    values = params.get(name)
+    if not values:
+        return default
+    try:
+        return int(values[-1])
+    except ValueError:
+        raise BadRequest(f'{name} must be an integer')
+
+
+# The limit parameter, at most maximum
+def limit_param(params, default, maximum):
+    limit = int_param(params, 'limit', default)
+    if limit < 0:
+        raise BadRequest('limit must not be negative')
+    return min(limit, maximum)
+
+
+# The queries behind the endpoints, returning frames. Each thread of the
+# server has its own read-only connection; every query is a short read
+# transaction of its own, so the ingester is never held up.
+class Queries:
+    def __init__(self, db_path, archive_dir):
+        self.db_path = db_path
+        self.archive_dir = archive_dir
+        self.local = threading.local()
+        # PRAGMA data_version is per connection, so one connection answers it
+        self.version_conn = self.connect()
+        self.version_lock = threading.Lock()
+
+    def connect(self):
+        conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True, check_same_thread=False)
+        conn.execute('PRAGMA busy_timeout=5000')
+        return conn
+
+    @property
+    def conn(self):
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = self.connect()
+        return self.local.conn
+
+    def query(self, sql, params=None):
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def data_version(self):
+        with self.version_lock:
+            return self.version_conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def version(self):
+        first_id, max_id = self.conn.execute('SELECT (SELECT min(id) FROM temp), (SELECT max(id) FROM temp)').fetchone()
+        return {'data_version': self.data_version(), 'first_id': first_id, 'max_id': max_id}
+
+    def topics(self):
+        return self.query('SELECT id, name FROM topics ORDER BY id')
+
+    # Topic ids selected by the topic and topic_id parameters, None for all.
+    # An empty topic_id= selects no topic.
+    def topic_ids(self, params):
+        if 'topic_id' not in params and 'topic' not in params:
+            return None
+        ids = [int(topic_id) for topic_id in params.get('topic_id', []) if topic_id.isdigit()]
+        names = params.get('topic', [])
+        if names:
+            ids += [row[0] for row in self.conn.execute(
+                f"SELECT id FROM topics WHERE name IN ({', '.join('?' * len(names))})", names)]
+        return sorted(set(ids))
+
+    # Adds the topic names to a frame with a topic_id column
+    def with_names(self, frame):
+        names = self.topics().set_index('id')['name']
+        frame.insert(frame.columns.get_loc('topic_id') + 1, 'topic', frame['topic_id'].map(names))
+        return frame
+
+    def latest(self, params):
+        frame = self.query(f'SELECT topic_id, value, ts FROM temp_latest WHERE {topic_condition(self.topic_ids(params))} ORDER BY topic_id')
+        return self.with_names(frame), None
+
+    def stats(self, params):
+        frame = self.query(f'''
+            SELECT topic_id, span, count, min, max, mean, std, rate, last_ts, updated FROM topic_stats
+            WHERE {topic_condition(self.topic_ids(params))} ORDER BY topic_id, span
+        ''')
+        return self.with_names(frame), None
+
+    def events(self, params):
+        limit = limit_param(params, 20, 1000)
+        return self.query('SELECT id, rule, state, ts, topic, value, message FROM alarm_events ORDER BY id DESC LIMIT ?', (limit,)), None
+
+    # The rules as the ingester's engine applies them (the same ALARM_*
+    # settings) and the state of each rule: its last transition, or None
+    # while it has never been raised
+    def alarms(self):
+        rules = alarms.Rules()
+        state = {rule: None for rule in alarms.RULES}
+        for rule, *event in self.conn.execute('''
+                SELECT rule, state, ts, topic, value, message FROM alarm_events
+                WHERE id IN (SELECT max(id) FROM alarm_events GROUP BY rule)'''):
+            state[rule] = dict(zip(('state', 'ts', 'topic', 'value', 'message'), event))
+        return {
+            'rules': {name: getattr(rules, name) for name in ('limit', 'band_min', 'band_max', 'hysteresis', 'debounce')},
+            'state': state,
+        }
+
+    # Returns (frame, cursor)
+    def series(self, params):
+        resolution = params.get('resolution', ['raw'])[-1]
+        if resolution != 'raw' and resolution not in ROLLUP_TABLES:
+            raise BadRequest('resolution must be raw, 1m or 1h')
+        topic_ids = self.topic_ids(params)
+        after = int_param(params, 'after')
+        span = int_param(params, 'span')
+        start = int_param(params, 'start')
+        if start is None and span is not None:
+            start = int(time.time() * 1000) - span
+        if start is None:
+            start = 0 if after is not None or resolution != 'raw' else int(time.time() * 1000) - DEFAULT_SPAN
+        end = int_param(params, 'end', 2 ** 62)
+        limit = limit_param(params, MAX_ROWS, MAX_ROWS)
+        if resolution == 'raw':
+            return self.raw_series(topic_ids, start, end, after, limit)
+        return self.rollup_series(ROLLUP_TABLES[resolution], topic_ids, start, end, after)
+
+    def raw_series(self, topic_ids, start, end, after, limit):
+        if after is None:
+            # Both tiers; the archive is read by topic name
+            topics = self.topics()
+            names = None
+            if topic_ids is not None:
+                names = topics.loc[topics['id'].isin(topic_ids), 'name'].tolist()
+            frame = archive.read_newest(self.conn, self.archive_dir, start, end, limit, names)
+            frame.insert(1, 'topic_id', frame['topic'].map(topics.set_index('name')['id']).astype('Int64'))
+            frame = frame[['id', 'topic_id', 'topic', 'value', 'message', 'ts']]
+            cursor = int(frame['id'].max()) if not frame.empty else after
+        else:
+            # The rows added since the cursor, of which the newest limit by
+            # time, oldest first. A backfill adds rows with new ids and old
+            # timestamps; they only come back when they are among the newest.
+            # The cursor moves past the rows left out, which are older than
+            # all rows returned, so the ids are capped first and rows
+            # committed meanwhile are not skipped.
+            newest = self.conn.execute('SELECT max(id) FROM temp').fetchone()[0] or 0
+            params = {'after': after, 'newest': newest, 'start': start, 'end': end, 'limit': limit}
+            if newest - after <= limit:
+                # A small delta: NOT INDEXED keeps SQLite on the id range;
+                # the ts indexes would walk the whole time range
+                frame = self.query(f'''
+                    SELECT * FROM (
+                        SELECT id, topic_id, value, message, ts FROM temp NOT INDEXED
+                        WHERE id > :after AND id <= :newest AND ts >= :start AND ts < :end AND {topic_condition(topic_ids)}
+                        ORDER BY ts DESC, id DESC LIMIT :limit
+                    ) ORDER BY ts, id
+                ''', params)
+            else:
+                # More rows than the limit, e.g. the first request with
+                # after=0: temp_ts or temp_topic_ts gives the newest rows
+                # first and the walk stops at the limit. The unary + keeps
+                # SQLite off the id range.
+                frame = self.query(f'''
+                    SELECT * FROM (
+                        SELECT id, topic_id, value, message, ts FROM temp
+                        WHERE +id > :after AND +id <= :newest AND ts >= :start AND ts < :end AND {topic_condition(topic_ids)}
+                        ORDER BY ts DESC, id DESC LIMIT :limit
+                    ) ORDER BY ts, id
+                ''', params)
+            frame = self.with_names(frame)
+            cursor = max(newest, after)
+        return frame, cursor
+
+    def rollup_series(self, table, topic_ids, start, end, after):
+        width = rollups.ROLLUPS[table]
+        if after is not None:
+            start = max(start, after)
+        frame = self.query(f'''
+            SELECT bucket AS ts, topic_id, sum / count AS value, min, max, count FROM {table}
+            WHERE bucket >= :start AND bucket < :end AND {topic_condition(topic_ids)}
+            ORDER BY bucket, topic_id
+        ''', {'start': start - start % width, 'end': end})
+        frame = self.with_names(frame)
+        cursor = int(frame['ts'].max()) if not frame.empty else after
+        return frame, cursor
+
+    # (chunks, format) of an export; topic ids are turned into the names
+    # both tiers can be filtered by
+    def export(self, params):
+        fmt = params.get('format', ['csv'])[-1]
+        if fmt not in export.FORMATS:
+            raise BadRequest('format must be csv or parquet')
+        names = None
+        topic_ids = self.topic_ids(params)
+        if topic_ids is not None:
+            topics = self.topics()
+            names = topics.loc[topics['id'].isin(topic_ids), 'name'].tolist()
+        span = int_param(params, 'span')
+        start = int_param(params, 'start')
+        if start is None:
+            start = int(time.time() * 1000) - span if span is not None else 0
+        end = int_param(params, 'end', 2 ** 62)
+        return export.chunks(self.conn, self.archive_dir, start, end, names), fmt
+
+
+def encode(frame, cursor, data_version, fmt):
+    headers = {'X-Data-Version': str(data_version)}
+    if cursor is not None:
+        headers['X-Cursor'] = str(cursor)
+    if fmt == 'arrow':
+        sink = pa.BufferOutputStream()
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return 'application/vnd.apache.arrow.stream', sink.getvalue().to_pybytes(), headers
+    # NaN is not JSON; missing values become null
+    columns = {name: [None if pd.isna(value) else value for value in frame[name].tolist()] for name in frame.columns}
+    body = json.dumps({'data_version': data_version, 'cursor': cursor, 'columns': columns})
+    return 'application/json', body.encode(), headers
+
+
+# Least recently used responses, keyed by request and data version. Entries
+# of older versions are never asked for again and fall out at the end.
+class ResponseCache:
+    def __init__(self, entries):
+        self.entries = entries
+        self.responses = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            response = self.responses.get(key)
+            if response is not None:
+                self.responses.move_to_end(key)
+            return response
+
+    def put(self, key, response):
+        with self.lock:
+            self.responses[key] = response
+            self.responses.move_to_end(key)
+            while len(self.responses) > self.entries:
+                self.responses.popitem(last=False)
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    queries = None
+    cache = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = parse_qs(url.query, keep_blank_values=True)
+        REQUESTS.inc(1, url.path if url.path in PATHS else 'other')
+        with REQUEST_SECONDS.time():
+            try:
+                if url.path == '/metrics':
+                    self.respond(200, 'text/plain; version=0.0.4', metrics.render().encode())
+                elif url.path == '/version':
+                    self.respond_json(self.queries.version())
+                elif url.path == '/alarms':
+                    self.respond_json(self.queries.alarms())
+                elif url.path == '/topics':
+                    self.respond_frame(url, params, lambda: (self.queries.topics(), None))
+                elif url.path in ('/latest', '/stats', '/events', '/series'):
+                    endpoint = getattr(self.queries, url.path[1:])
+                    self.respond_frame(url, params, lambda: endpoint(params))
+                elif url.path == '/export':
+                    self.respond_export(params)
+                else:
+                    self.send_error(404)
+            except BadRequest as e:
+                self.send_error(400, str(e))
+            except sqlite3.Error as e:
+                self.send_error(503, f'Database error: {e}')
+            except Exception as e:
+                print(f"Error answering {self.path}: {e!r}", flush=True)
+                self.send_error(500)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        REQUESTS.inc(1, url.path if url.path in PATHS else 'other')
+        if url.path != '/reset':
+            self.send_error(404)
+            return
+        token = self.headers.get('X-Reset-Token', '')
+        if not RESET_TOKEN or not hmac.compare_digest(token.encode(), RESET_TOKEN.encode()):
+            self.send_error(403, 'Reset needs the X-Reset-Token header' if RESET_TOKEN else 'Reset is disabled (no RESET_TOKEN)')
+            return
+        # The ingester carries out the reset between two batches
+        with open(archive.RESET_REQUEST, 'w'):
+            pass
+        self.respond_json({'reset': 'requested'}, status=202)
+
+    def respond_frame(self, url, params, load):
+        fmt = params.get('format', ['json'])[-1]
+        if fmt not in ('json', 'arrow'):
+            raise BadRequest('format must be json or arrow')
+        # Read the version first: a commit landing during the query makes
+        # the response newer than its key, never older
+        data_version = self.queries.data_version()
+        key = (url.path, tuple(sorted((name, tuple(values)) for name, values in params.items())), data_version)
+        response = self.cache.get(key)
+        if response is not None:
+            CACHE_HITS.inc()
+        else:
+            frame, cursor = load()
+            response = encode(frame, cursor, data_version, fmt)
+            self.cache.put(key, response)
+        content_type, body, headers = response
+        self.respond(200, content_type, body, headers)
+
+    # Streams the export; without a Content-Length the end of the body is
+    # the end of the connection. An error after the headers went out can
+    # only cut the download short.
+    def respond_export(self, params):
+        tables, fmt = self.queries.export(params)
+        # Fetch the first chunk before answering, so errors opening the
+        # export still get a proper status
+        first = next(tables, None)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv' if fmt == 'csv' else 'application/vnd.apache.parquet')
+        self.send_header('Content-Disposition', f'attachment; filename="temperatur-{int(time.time())}.{fmt}"')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            export.write(self.wfile, itertools.chain([first] if first is not None else [], tables), fmt)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Export cut short: {e!r}", flush=True)
+
+    def respond_json(self, value, status=200):
+        self.respond(status, 'application/json', json.dumps(value).encode())
+
+    def respond(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    # One line per request would drown the log at dashboard refresh rates
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    QueryHandler.queries = Queries(DB_PATH, archive.ARCHIVE_DIR)
+    QueryHandler.cache = ResponseCache(CACHE_ENTRIES)
+    server = ThreadingHTTPServer(('', QUERY_PORT), QueryHandler)
+    print(f"Serving {DB_PATH} on port {QUERY_PORT}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
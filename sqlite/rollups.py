@@ -0,0 +1,64 @@
+# Rollup tables and their bucket width in milliseconds (see init.sql)
+ROLLUPS = {
+    'temp_1m': 60 * 1000,
+    'temp_1h': 60 * 60 * 1000,
+}
+
+
+# Folds a batch of (topic_id, value, message, ts) rows into the rollup tables.
+# The batch is aggregated in memory first, so each table gets one upsert per
+# (bucket, topic_id) touched rather than one per reading.
+def update_rollups(conn, rows):
+    for table, buckets in aggregate(rows).items():
+        if buckets:
+            merge_buckets(conn, table, buckets)
+
+
+# The rows' (bucket, topic, count, sum, min, max) aggregates per rollup
+# table. topic is the rows' first field: a topic id, or a name in the
+# workers of the sharded ingester.
+def aggregate(rows):
+    tables = {}
+    for table, width in ROLLUPS.items():
+        buckets = {}
+        for topic_id, value, _message, ts in rows:
+            if value is None:
+                continue
+            key = (ts - ts % width, topic_id)
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = [1, value, value, value]
+            else:
+                bucket[0] += 1
+                bucket[1] += value
+                if value < bucket[2]:
+                    bucket[2] = value
+                if value > bucket[3]:
+                    bucket[3] = value
+        tables[table] = [key + tuple(bucket) for key, bucket in buckets.items()]
+    return tables
+
+
+# Adds (bucket, topic_id, count, sum, min, max) aggregates to a rollup table
+def merge_buckets(conn, table, buckets):
+    conn.executemany(f'''
+        INSERT INTO {table} (bucket, topic_id, count, sum, min, max) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (bucket, topic_id) DO UPDATE SET
+            count = count + excluded.count,
+            sum = sum + excluded.sum,
+            min = min(min, excluded.min),
+            max = max(max, excluded.max)
+    ''', buckets)
+
+
+# Rebuilds the rollup tables from the raw rows
+def rebuild_rollups(conn):
+    for table, width in ROLLUPS.items():
+        conn.execute(f'DELETE FROM {table}')
+        conn.execute(f'''
+            INSERT INTO {table} (bucket, topic_id, count, sum, min, max)
+            SELECT ts - ts % {width}, topic_id, count(*), sum(value), min(value), max(value)
+            FROM temp
+            WHERE value IS NOT NULL
+            GROUP BY 1, 2
+        ''')
@@ -0,0 +1,213 @@
+import math
+import os
+
+import alarms
+import rollups
+import topic_stats
+
+# The canonical schema lives in init.sql, next to this file (both are copied to / in the image)
+INIT_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'init.sql')
+
+# Stored in PRAGMA user_version. Bump it and append a migration below
+# whenever init.sql changes.
+#   0 - legacy layouts: (message TEXT, timestamp DATETIME) from mqtt_logger.sh
+#       or (message REAL, logget_tid DATETIME) from the old init.sql
+#   1 - numeric value column, integer epoch-ms ts, covering indexes
+#   2 - temp_1m / temp_1h rollup tables
+#   3 - temp_latest, newest reading per topic
+#   4 - alarm_events
+#   5 - topics registry; temp, rollups and temp_latest refer to it by topic_id
+#   6 - topic_stats, rolling statistics per topic
+#   7 - no readings of the alarm engine's own ALARM_TOPIC/<rule> topics
+SCHEMA_VERSION = 7
+
+
+# Returns the payload as a float, or None if it is not a finite number
+def parse_value(message):
+    if message is None:
+        return None
+    try:
+        value = float(message)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def migrate_to_1(conn):
+    columns = table_columns(conn, 'temp')
+    time_column = 'timestamp' if 'timestamp' in columns else 'logget_tid'
+    before = conn.execute('SELECT count(*) FROM temp').fetchone()[0]
+
+    # Renaming the table renames its sqlite_sequence row too; the copy below
+    # only raises the new one to the highest id left
+    sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'temp'").fetchone()
+
+    conn.create_function('parse_value', 1, parse_value, deterministic=True)
+    conn.execute('ALTER TABLE temp RENAME TO temp_legacy')
+    conn.execute('CREATE TABLE temp (id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT NOT NULL, value REAL, message TEXT, ts INTEGER NOT NULL)')
+    # Ids are kept so anything that remembered an id stays valid. Timestamps
+    # were written by CURRENT_TIMESTAMP, i.e. UTC text.
+    conn.execute(f'''
+        INSERT INTO temp (id, topic, value, message, ts)
+        SELECT id,
+               COALESCE(topic, ''),
+               parse_value(message),
+               CASE WHEN parse_value(message) IS NULL THEN CAST(message AS TEXT) END,
+               COALESCE(CAST(strftime('%s', {time_column}) AS INTEGER) * 1000, 0)
+        FROM temp_legacy
+    ''')
+    after = conn.execute('SELECT count(*) FROM temp').fetchone()[0]
+    if after != before:
+        raise RuntimeError(f'Migration copied {after} of {before} rows')
+    conn.execute('DROP TABLE temp_legacy')
+    if sequence is not None:
+        if conn.execute("UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name = 'temp'", sequence).rowcount == 0:
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('temp', ?)", sequence)
+    conn.execute('CREATE INDEX temp_topic_ts ON temp (topic, ts, value)')
+    conn.execute('CREATE INDEX temp_ts ON temp (ts, topic, value)')
+
+
+# Migrations 2 and 3 fill their tables with the SQL of that version, as
+# rollups.py and latest.py now work on topic ids
+def migrate_to_2(conn):
+    for table, width in rollups.ROLLUPS.items():
+        conn.execute(f'CREATE TABLE {table} (bucket INTEGER NOT NULL, topic TEXT NOT NULL, count INTEGER NOT NULL, sum REAL NOT NULL, min REAL NOT NULL, max REAL NOT NULL, PRIMARY KEY (bucket, topic)) WITHOUT ROWID')
+        conn.execute(f'''
+            INSERT INTO {table} (bucket, topic, count, sum, min, max)
+            SELECT ts - ts % {width}, topic, count(*), sum(value), min(value), max(value)
+            FROM temp
+            WHERE value IS NOT NULL
+            GROUP BY 1, 2
+        ''')
+
+
+def migrate_to_3(conn):
+    conn.execute('CREATE TABLE temp_latest (topic TEXT PRIMARY KEY, value REAL NOT NULL, ts INTEGER NOT NULL)')
+    conn.execute('''
+        INSERT INTO temp_latest (topic, value, ts)
+        SELECT topic, value, max(ts) FROM temp WHERE value IS NOT NULL GROUP BY topic
+    ''')
+
+
+def migrate_to_4(conn):
+    conn.execute('CREATE TABLE alarm_events (id INTEGER PRIMARY KEY AUTOINCREMENT, rule TEXT NOT NULL, state TEXT NOT NULL, ts INTEGER NOT NULL, topic TEXT, value REAL, message TEXT)')
+
+
+# Copies table into a new table created by create_sql, with the topic column
+# replaced by topic_id, and puts it in the old one's place
+def replace_topic_column(conn, table, create_sql, columns):
+    conn.execute(f'ALTER TABLE {table} RENAME TO {table}_v4')
+    conn.execute(create_sql)
+    old_columns = ', '.join('topics.id' if column == 'topic_id' else f'old.{column}' for column in columns)
+    conn.execute(f'''
+        INSERT INTO {table} ({', '.join(columns)})
+        SELECT {old_columns} FROM {table}_v4 AS old JOIN topics ON topics.name = old.topic
+    ''')
+    before = conn.execute(f'SELECT count(*) FROM {table}_v4').fetchone()[0]
+    after = conn.execute(f'SELECT count(*) FROM {table}').fetchone()[0]
+    if after != before:
+        raise RuntimeError(f'Migration copied {after} of {before} rows of {table}')
+    conn.execute(f'DROP TABLE {table}_v4')
+
+
+def migrate_to_5(conn):
+    conn.execute('CREATE TABLE topics (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+    # temp_1h also holds the topics whose raw rows are all archived
+    conn.execute('''
+        INSERT INTO topics (name)
+        SELECT topic FROM temp UNION SELECT topic FROM temp_1h UNION SELECT topic FROM temp_latest
+    ''')
+
+    # Keep the id sequence going, even when temp is empty: the archive
+    # tells rows apart by id
+    sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'temp'").fetchone()
+    conn.execute('DROP INDEX temp_topic_ts')
+    conn.execute('DROP INDEX temp_ts')
+    replace_topic_column(conn, 'temp',
+                         'CREATE TABLE temp (id INTEGER PRIMARY KEY AUTOINCREMENT, topic_id INTEGER NOT NULL REFERENCES topics (id), value REAL, message TEXT, ts INTEGER NOT NULL)',
+                         ['id', 'topic_id', 'value', 'message', 'ts'])
+    if sequence is not None:
+        if conn.execute("UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name = 'temp'", sequence).rowcount == 0:
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('temp', ?)", sequence)
+    conn.execute('CREATE INDEX temp_topic_ts ON temp (topic_id, ts, value)')
+    conn.execute('CREATE INDEX temp_ts ON temp (ts, topic_id, value)')
+
+    for table in rollups.ROLLUPS:
+        replace_topic_column(conn, table,
+                             f'CREATE TABLE {table} (bucket INTEGER NOT NULL, topic_id INTEGER NOT NULL REFERENCES topics (id), count INTEGER NOT NULL, sum REAL NOT NULL, min REAL NOT NULL, max REAL NOT NULL, PRIMARY KEY (bucket, topic_id)) WITHOUT ROWID',
+                             ['bucket', 'topic_id', 'count', 'sum', 'min', 'max'])
+    replace_topic_column(conn, 'temp_latest',
+                         'CREATE TABLE temp_latest (topic_id INTEGER PRIMARY KEY REFERENCES topics (id), value REAL NOT NULL, ts INTEGER NOT NULL)',
+                         ['topic_id', 'value', 'ts'])
+
+
+# The windows are filled in by the ingester when it starts
+def migrate_to_6(conn):
+    conn.execute('CREATE TABLE topic_stats (topic_id INTEGER NOT NULL REFERENCES topics (id), span TEXT NOT NULL, count INTEGER NOT NULL, min REAL, max REAL, mean REAL, std REAL, rate REAL, last_ts INTEGER, updated INTEGER NOT NULL, PRIMARY KEY (topic_id, span)) WITHOUT ROWID')
+    topic_stats.rebuild_totals(conn)
+
+
+# Version 6 stored the ingester's own retained transitions as readings of
+# ALARM_TOPIC/<rule>, which then counted as sensors. Rows already moved to
+# the archive stay there; its readers skip these topics.
+def migrate_to_7(conn):
+    names = sorted(alarms.OWN_TOPICS)
+    own = f"SELECT id FROM topics WHERE name IN ({', '.join('?' * len(names))})"
+    for table in ('temp', 'temp_1m', 'temp_1h', 'temp_latest', 'topic_stats'):
+        conn.execute(f'DELETE FROM {table} WHERE topic_id IN ({own})', names)
+    conn.execute(f"DELETE FROM topics WHERE name IN ({', '.join('?' * len(names))})", names)
+
+
+# MIGRATIONS[n] upgrades a database from version n to n + 1
+MIGRATIONS = [migrate_to_1, migrate_to_2, migrate_to_3, migrate_to_4, migrate_to_5, migrate_to_6, migrate_to_7]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def has_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+# Creates the schema in a new database or upgrades an existing one in place.
+# Every step runs in its own transaction, so a failed step leaves the
+# database at the previous version. Returns the list of versions applied.
+def ensure_schema(conn):
+    applied = []
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        version = schema_version(conn)
+        if version == 0 and not has_table(conn, 'temp'):
+            with open(INIT_SQL) as f:
+                script = f.read()
+            try:
+                conn.executescript(f'BEGIN IMMEDIATE;\n{script}\nPRAGMA user_version = {SCHEMA_VERSION};\nCOMMIT;')
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute('ROLLBACK')
+                raise
+            return [SCHEMA_VERSION]
+
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f'Database schema version {version} is newer than this code ({SCHEMA_VERSION})')
+
+        while version < SCHEMA_VERSION:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                MIGRATIONS[version](conn)
+                version += 1
+                conn.execute(f'PRAGMA user_version = {version}')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            applied.append(version)
+    finally:
+        conn.isolation_level = isolation_level
+    return applied
@@ -0,0 +1,93 @@
+import json
+import os
+import threading
+
+# Append-only overflow file for messages the writer cannot take yet (see
+# ingester.py). Every line is one message, JSON [received, rows]. Lines are
+# read back from an offset that is saved next to the file once their rows
+# are committed, so a restart picks up the backlog where it stopped; once
+# everything has been read back the file is emptied.
+#
+# Appending only flushes to the OS, like the database's synchronous=NORMAL:
+# a crash of the process loses nothing, a power cut may lose the last lines.
+
+
+class Spool:
+    def __init__(self, path):
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.lock = threading.Lock()
+        self.writer = open(path, 'ab')
+        self.size = os.path.getsize(path)
+        # A crash in the middle of an append leaves a torn last line; cut it
+        # off, or the next append would be glued to it
+        complete = self.size
+        with open(path, 'rb') as f:
+            while complete > 0:
+                start = max(0, complete - 65536)
+                f.seek(start)
+                newline = f.read(complete - start).rfind(b'\n')
+                if newline >= 0:
+                    complete = start + newline + 1
+                    break
+                complete = start
+        if complete < self.size:
+            self.writer.truncate(complete)
+            self.size = complete
+        self.offset = 0
+        if os.path.exists(self.offset_path):
+            with open(self.offset_path) as f:
+                self.offset = min(int(f.read() or 0), self.size)
+
+    # Appends (received, rows) messages
+    def append(self, messages):
+        data = b''.join(json.dumps(message).encode() + b'\n' for message in messages)
+        with self.lock:
+            self.writer.write(data)
+            self.writer.flush()
+            self.size += len(data)
+
+    # True while there are lines that have not been read back
+    def pending(self):
+        return self.offset < self.size
+
+    # Bytes not yet read back
+    def backlog(self):
+        return self.size - self.offset
+
+    # Reads messages from the offset until they hold about max_rows rows.
+    # Returns them and the offset to commit once they are written.
+    def read(self, max_rows):
+        with self.lock:
+            end = self.size
+        messages = []
+        rows = 0
+        offset = self.offset
+        # A fresh handle, so nothing is read from a buffer of a file that has
+        # been emptied and written again since
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            while offset < end and rows < max_rows:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                received, message_rows = json.loads(line)
+                messages.append((received, [tuple(row) for row in message_rows]))
+                rows += len(message_rows)
+        return messages, offset
+
+    # Marks everything before offset as written. Empties the file when
+    # nothing was appended in the meantime.
+    def commit(self, offset):
+        with self.lock:
+            if offset >= self.size:
+                self.writer.truncate(0)
+                self.size = 0
+                offset = 0
+            self.offset = offset
+        # Written aside and renamed, so a crash never leaves an empty offset
+        # file behind, which would replay the whole spool
+        with open(self.offset_path + '.tmp', 'w') as f:
+            f.write(str(offset))
+        os.replace(self.offset_path + '.tmp', self.offset_path)
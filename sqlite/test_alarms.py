@@ -0,0 +1,50 @@
+import sqlite3
+
+import alarms
+import schema
+
+
+def database():
+    conn = sqlite3.connect(':memory:')
+    schema.ensure_schema(conn)
+    return conn
+
+
+# A rule stored as raised without any reading since, e.g. when the ingester
+# restarts right after a reset, is cleared instead of failing on the tick
+def test_restored_alarm_without_readings_clears():
+    conn = database()
+    alarms.store_events(conn, [{'rule': 'critical', 'state': 'raised', 'ts': 1000, 'topic': 't', 'value': 56.0, 'message': ''}])
+    engine = alarms.AlarmEngine(alarms.Rules(debounce=0))
+    engine.restore(conn)
+    engine.tick(2000)
+    events = engine.take_events()
+    assert [(event['rule'], event['state'], event['topic']) for event in events] == [('critical', 'cleared', None)]
+
+
+# After a reset the raised rules are cleared and published again
+def test_clear_publishes_cleared_rules():
+    published = []
+    engine = alarms.AlarmEngine(alarms.Rules(debounce=0), publish=lambda rule, event: published.append((rule, event['state'])))
+    engine.process('t', 56.0, 1000)
+    assert engine.active == {'critical': True, 'band': True}
+    engine.clear(2000)
+    assert engine.active == {'critical': False, 'band': False}
+    assert published[-2:] == [('critical', 'cleared'), ('band', 'cleared')]
+    engine.tick(3000)
+    assert [event['state'] for event in engine.take_events()] == ['raised', 'raised', 'cleared', 'cleared']
+
+
+def test_own_topics():
+    assert alarms.own_topic(f'{alarms.ALARM_TOPIC}/critical')
+    assert not alarms.own_topic(f'{alarms.ALARM_TOPIC}/freezer')
+
+
+# Readings of a topic that arrive out of order, e.g. through different
+# ingest workers, do not replace its newer value
+def test_older_reading_is_skipped():
+    engine = alarms.AlarmEngine(alarms.Rules(debounce=0))
+    engine.process_rows([('t', 50.0, None, 2000)], 2000)
+    engine.process_rows([('t', 56.0, None, 1000)], 2100)
+    assert engine.topics['t'][0] == 50.0
+    assert not engine.active['critical']
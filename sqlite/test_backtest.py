@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+import alarms
+import backtest
+
+
+# Readings of a few topics one second apart, each a random walk around the
+# band and the limit, so both rules are raised and cleared many times
+def random_walk(count=20000, topics=5, seed=7):
+    rng = np.random.default_rng(seed)
+    ts = 10 ** 12 + np.arange(count, dtype=np.int64) * 1000
+    codes = rng.integers(0, topics, count)
+    values = np.empty(count)
+    level = np.full(topics, 57.0)
+    for i, code in enumerate(codes):
+        level[code] += rng.normal(0, 0.4) - (level[code] - 57) * 0.01
+        values[i] = round(level[code], 1)
+    return ts, codes, values
+
+
+# The replay gives the transitions AlarmEngine makes when it is fed the same
+# readings with their timestamps
+@pytest.mark.parametrize('debounce', [0, 5, 30])
+def test_backtest_matches_engine(debounce):
+    ts, codes, values = random_walk()
+    end = int(ts[-1]) + 500
+    rules = alarms.Rules(debounce=debounce)
+    engine = alarms.AlarmEngine(rules)
+    for t, code, value in zip(ts.tolist(), codes.tolist(), values.tolist()):
+        engine.process(f't{code}', value, t)
+    engine.tick(end)
+    events = engine.take_events()
+
+    conditions = backtest.conditions(rules, backtest.topic_order(codes), values)
+    for rule in alarms.RULES:
+        raised, cleared, still_raised = backtest.rule_intervals(ts, conditions[rule], debounce * 1000, end)
+        expected = sorted([(int(t), 'raised') for t in raised] +
+                          [(int(t), 'cleared') for t in cleared[:len(cleared) - still_raised]])
+        transitions = [(event['ts'], event['state']) for event in events if event['rule'] == rule]
+        assert transitions, rule
+        assert transitions == expected
+        assert still_raised == (transitions[-1][1] == 'raised')
@@ -0,0 +1,48 @@
+import struct
+
+import payloads
+
+RECEIVED = 1718000000000
+
+
+def test_scalar():
+    assert payloads.decode('t', b'58.3', RECEIVED) == [('t', 58.3, None, RECEIVED)]
+    assert payloads.decode('t', b'door open', RECEIVED) == [('t', None, 'door open', RECEIVED)]
+
+
+def test_json_readings():
+    assert payloads.decode('t', b'{"ts": 1717999999000, "value": 58.3}', RECEIVED) == [('t', 58.3, None, 1717999999000)]
+    assert payloads.decode('t', b'[[1717999998000, 58.3], [1717999999000, "off"]]', RECEIVED) == [
+        ('t', 58.3, None, 1717999998000), ('t', None, 'off', 1717999999000)]
+    # Without a ts a reading gets the receive time
+    assert payloads.decode('t', b'{"value": 1}', RECEIVED) == [('t', 1.0, None, RECEIVED)]
+
+
+def test_channels():
+    assert payloads.decode('line1', b'{"ts": 1717999999000, "channels": {"T1": 58.3, "T2": 59.1}}', RECEIVED) == [
+        ('line1/T1', 58.3, None, 1717999999000), ('line1/T2', 59.1, None, 1717999999000)]
+
+
+def test_other_json_is_a_message():
+    assert payloads.decode('t', b'{"state": "on"}', RECEIVED) == [('t', None, '{"state": "on"}', RECEIVED)]
+
+
+def test_binary():
+    payload = payloads.BINARY_MAGIC + struct.pack('<qdqd', 1717999999000, 58.3, 1717999999500, float('nan'))
+    assert payloads.decode('t', payload, RECEIVED) == [('t', 58.3, None, 1717999999000), ('t', None, 'nan', 1717999999500)]
+    assert payloads.decode('t', payloads.BINARY_MAGIC + b'\x01\x02', RECEIVED)[0][2] == 'Malformed binary payload (6 bytes)'
+
+
+# Timestamps before 1970, too far ahead, not numbers or too large for SQLite
+# are replaced by the receive time
+def test_bad_ts():
+    for ts in ('-1', str(RECEIVED + 3600 * 1000), 'true', '"now"', '1e400', '1' + '0' * 400):
+        assert payloads.decode('t', f'{{"ts": {ts}, "value": 1}}'.encode(), RECEIVED) == [('t', 1.0, None, RECEIVED)], ts
+    payload = payloads.BINARY_MAGIC + struct.pack('<qd', -5, 1.0)
+    assert payloads.decode('t', payload, RECEIVED) == [('t', 1.0, None, RECEIVED)]
+
+
+# Numbers too large for a float are kept as text
+def test_overflowing_value():
+    value = '1' + '0' * 400
+    assert payloads.decode('t', value.encode(), RECEIVED) == [('t', None, value, RECEIVED)]
@@ -0,0 +1,63 @@
+import sqlite3
+
+import pytest
+
+import schema
+
+# The two layouts found in the field before schema versions (see schema.py)
+LEGACY_LAYOUTS = {
+    'mqtt_logger.sh': 'CREATE TABLE temp (id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT, message TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)',
+    'init.sql': 'CREATE TABLE temp (id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT NOT NULL, message REAL NOT NULL, logget_tid DATETIME DEFAULT CURRENT_TIMESTAMP)',
+}
+
+ROWS = [
+    ('line1/T1', '58.5', '2025-01-01 00:00:00'),
+    ('line1/T2', '59', '2025-01-01 00:00:30'),
+    ('line1/T1', 'sensor offline', '2025-01-01 00:01:00'),
+    ('line1/T1', '57.25', '2025-01-01 01:00:00'),
+    ('alarms/freezer', '-18', '2025-01-01 01:00:00'),
+    # The alarm engine's own transitions, dropped by version 7
+    ('alarms/critical', '{"state": "raised"}', '2025-01-01 01:00:00'),
+    # Deleted again, so the id sequence is ahead of the highest id
+    ('line1/T2', '60', '2025-01-01 02:00:00'),
+]
+
+
+# Upgrading either legacy layout keeps every row with its id, value or
+# message and time, and the id sequence
+@pytest.mark.parametrize('layout', LEGACY_LAYOUTS)
+def test_upgrade_legacy_layout(layout):
+    conn = sqlite3.connect(':memory:')
+    conn.execute(LEGACY_LAYOUTS[layout])
+    time_column = 'timestamp' if layout == 'mqtt_logger.sh' else 'logget_tid'
+    conn.executemany(f'INSERT INTO temp (topic, message, {time_column}) VALUES (?, ?, ?)', ROWS)
+    conn.execute('DELETE FROM temp WHERE id = 7')
+    conn.commit()
+
+    assert schema.ensure_schema(conn) == list(range(1, schema.SCHEMA_VERSION + 1))
+    assert schema.schema_version(conn) == schema.SCHEMA_VERSION
+    assert conn.execute('''
+        SELECT temp.id, topics.name, value, message, ts FROM temp JOIN topics ON topics.id = topic_id ORDER BY temp.id
+    ''').fetchall() == [
+        (1, 'line1/T1', 58.5, None, 1735689600000),
+        (2, 'line1/T2', 59.0, None, 1735689630000),
+        (3, 'line1/T1', None, 'sensor offline', 1735689660000),
+        (4, 'line1/T1', 57.25, None, 1735693200000),
+        (5, 'alarms/freezer', -18.0, None, 1735693200000),
+    ]
+    assert conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'temp'").fetchone() == (7,)
+
+    # The derived tables agree with the rows
+    assert conn.execute('''
+        SELECT name, value, ts FROM temp_latest JOIN topics ON topics.id = topic_id ORDER BY name
+    ''').fetchall() == [('alarms/freezer', -18.0, 1735693200000), ('line1/T1', 57.25, 1735693200000), ('line1/T2', 59.0, 1735689630000)]
+    assert conn.execute('SELECT sum(count) FROM temp_1m').fetchone() == (4,)
+    assert conn.execute('SELECT sum(count) FROM temp_1h').fetchone() == (4,)
+    assert conn.execute("SELECT count FROM topic_stats JOIN topics ON topics.id = topic_id WHERE name = 'line1/T1' AND span = 'all'").fetchone() == (2,)
+
+    # A new row continues after the sequence
+    conn.execute('INSERT INTO temp (topic_id, value, ts) VALUES (1, 1.0, 0)')
+    assert conn.execute('SELECT max(id) FROM temp').fetchone() == (8,)
+
+    # Upgrading again changes nothing
+    assert schema.ensure_schema(conn) == []
@@ -0,0 +1,53 @@
+import spool
+
+
+def test_roundtrip(tmp_path):
+    path = str(tmp_path / 'spool.jsonl')
+    s = spool.Spool(path)
+    assert not s.pending()
+    s.append([(1000, [('a', 1.5, None, 900)]), (2000, [('b', None, 'off', 2000), ('b', 2.0, None, 2000)])])
+    assert s.pending() and s.backlog() > 0
+
+    # Reads whole messages until they hold max_rows rows
+    messages, offset = s.read(1)
+    assert messages == [(1000, [('a', 1.5, None, 900)])]
+    s.commit(offset)
+    messages, offset = s.read(10)
+    assert messages == [(2000, [('b', None, 'off', 2000), ('b', 2.0, None, 2000)])]
+
+    # Everything read back: the file is emptied
+    s.commit(offset)
+    assert not s.pending() and s.backlog() == 0
+    assert (tmp_path / 'spool.jsonl').stat().st_size == 0
+
+
+def test_restart_resumes_at_committed_offset(tmp_path):
+    path = str(tmp_path / 'spool.jsonl')
+    s = spool.Spool(path)
+    s.append([(1000, [('a', 1.0, None, 1000)]), (2000, [('a', 2.0, None, 2000)])])
+    _messages, offset = s.read(1)
+    s.commit(offset)
+    # A torn last line from a crash in the middle of an append
+    with open(path, 'ab') as f:
+        f.write(b'[3000, [["a", 3.0')
+
+    s = spool.Spool(path)
+    messages, offset = s.read(10)
+    assert messages == [(2000, [('a', 2.0, None, 2000)])]
+    s.commit(offset)
+    assert not s.pending()
+
+
+# The offset is replaced as a whole: a temporary file left by a crash is
+# ignored and the committed offset still holds
+def test_offset_survives_interrupted_commit(tmp_path):
+    path = str(tmp_path / 'spool.jsonl')
+    s = spool.Spool(path)
+    s.append([(1000, [('a', 1.0, None, 1000)]), (2000, [('a', 2.0, None, 2000)])])
+    _messages, offset = s.read(1)
+    s.commit(offset)
+    assert not (tmp_path / 'spool.jsonl.offset.tmp').exists()
+    (tmp_path / 'spool.jsonl.offset.tmp').write_text('')
+
+    messages, _offset = spool.Spool(path).read(10)
+    assert messages == [(2000, [('a', 2.0, None, 2000)])]
@@ -0,0 +1,241 @@
+import os
+import time
+
+# Rolling statistics per topic (see topic_stats in init.sql), kept in memory
+# by the ingester and updated with every numeric reading at O(1) cost. Each
+# window is a ring of BUCKETS buckets; a bucket holds the count, mean and M2
+# (Welford) of its readings, their min and max, and their mean and newest
+# timestamp. A window's figures combine its live buckets, so they slide in
+# steps of window / BUCKETS and nothing is ever scanned:
+#   count, min, max, mean, std  over the readings in the window
+#   rate                        change per minute, from the mean of the oldest
+#                               bucket to that of the newest one
+#   last_ts                     the newest reading; readers turn it into the
+#                               time since the last reading
+# The 'all' row covers every reading ever stored (count, min, max and mean;
+# std and rate are NULL), so it is the true total, archived rows included.
+
+# Comma-separated window lengths with a unit of s, m, h or d
+STATS_WINDOWS = os.environ.get('STATS_WINDOWS', '5m,1h,24h')
+
+BUCKETS = 30
+
+UNITS = {'s': 1000, 'm': 60 * 1000, 'h': 60 * 60 * 1000, 'd': 24 * 60 * 60 * 1000}
+
+
+# Window label -> length in milliseconds
+def parse_windows(spec):
+    return {label: int(label[:-1]) * UNITS[label[-1]] for label in (part.strip() for part in spec.split(',')) if label}
+
+
+WINDOWS = parse_windows(STATS_WINDOWS)
+
+# Bucket fields
+INDEX, COUNT, MEAN, M2, MIN, MAX, MEAN_TS, LAST_TS = range(8)
+
+
+def new_bucket(index):
+    return [index, 0, 0.0, 0.0, None, None, 0.0, None]
+
+
+class Ring:
+    def __init__(self, length):
+        self.width = max(1, length // BUCKETS)
+        self.buckets = [None] * BUCKETS
+
+    # The bucket for ts, None when ts is older than the window the ring
+    # currently holds
+    def bucket(self, ts):
+        return self.bucket_at(ts // self.width)
+
+    def bucket_at(self, index):
+        slot = index % BUCKETS
+        bucket = self.buckets[slot]
+        if bucket is None or bucket[INDEX] < index:
+            bucket = self.buckets[slot] = new_bucket(index)
+        elif bucket[INDEX] > index:
+            return None
+        return bucket
+
+    def add(self, value, ts):
+        bucket = self.bucket(ts)
+        if bucket is None:
+            return
+        bucket[COUNT] += 1
+        count = bucket[COUNT]
+        delta = value - bucket[MEAN]
+        bucket[MEAN] += delta / count
+        bucket[M2] += delta * (value - bucket[MEAN])
+        bucket[MIN] = value if bucket[MIN] is None or value < bucket[MIN] else bucket[MIN]
+        bucket[MAX] = value if bucket[MAX] is None or value > bucket[MAX] else bucket[MAX]
+        bucket[MEAN_TS] += (ts - bucket[MEAN_TS]) / count
+        if bucket[LAST_TS] is None or ts > bucket[LAST_TS]:
+            bucket[LAST_TS] = ts
+
+    # Folds in a bucket of another ring of the same width (Chan et al. for
+    # the mean and M2)
+    def merge(self, other):
+        bucket = self.bucket_at(other[INDEX])
+        if bucket is None or not other[COUNT]:
+            return
+        count = bucket[COUNT] + other[COUNT]
+        delta = other[MEAN] - bucket[MEAN]
+        bucket[M2] += other[M2] + delta * delta * bucket[COUNT] * other[COUNT] / count
+        bucket[MEAN] += delta * other[COUNT] / count
+        bucket[MIN] = other[MIN] if bucket[MIN] is None or other[MIN] < bucket[MIN] else bucket[MIN]
+        bucket[MAX] = other[MAX] if bucket[MAX] is None or other[MAX] > bucket[MAX] else bucket[MAX]
+        bucket[MEAN_TS] += (other[MEAN_TS] - bucket[MEAN_TS]) * other[COUNT] / count
+        if bucket[LAST_TS] is None or other[LAST_TS] > bucket[LAST_TS]:
+            bucket[LAST_TS] = other[LAST_TS]
+        bucket[COUNT] = count
+
+    # (count, min, max, mean, std, rate, last_ts) over the buckets still in
+    # the window at now (epoch ms)
+    def summary(self, now):
+        oldest = now // self.width - BUCKETS
+        live = sorted((bucket for bucket in self.buckets if bucket is not None and bucket[INDEX] > oldest and bucket[COUNT]),
+                      key=lambda bucket: bucket[INDEX])
+        if not live:
+            return (0, None, None, None, None, None, None)
+        count = sum(bucket[COUNT] for bucket in live)
+        mean = sum(bucket[COUNT] * bucket[MEAN] for bucket in live) / count
+        # Chan et al.: M2 of the union of the buckets
+        m2 = sum(bucket[M2] + bucket[COUNT] * (bucket[MEAN] - mean) ** 2 for bucket in live)
+        std = (m2 / (count - 1)) ** 0.5 if count > 1 else None
+        first, last = live[0], live[-1]
+        rate = None
+        if last[MEAN_TS] > first[MEAN_TS]:
+            rate = (last[MEAN] - first[MEAN]) / ((last[MEAN_TS] - first[MEAN_TS]) / 60000)
+        return (count, min(bucket[MIN] for bucket in live), max(bucket[MAX] for bucket in live),
+                mean, std, rate, max(bucket[LAST_TS] for bucket in live))
+
+
+class TopicStats:
+    def __init__(self, windows=WINDOWS):
+        self.windows = windows
+        # topic_id -> {label: Ring}
+        self.rings = {}
+        # topic_id -> [count, sum, min, max, last_ts] over all readings
+        self.totals = {}
+
+    def rings_of(self, topic_id):
+        rings = self.rings.get(topic_id)
+        if rings is None:
+            rings = self.rings[topic_id] = {label: Ring(length) for label, length in self.windows.items()}
+        return rings
+
+    # Folds (topic_id, value, message, ts) rows in; returns the topic ids
+    # that had numeric readings
+    def update(self, rows):
+        touched = set()
+        for topic_id, value, _message, ts in rows:
+            if value is None:
+                continue
+            for ring in self.rings_of(topic_id).values():
+                ring.add(value, ts)
+            total = self.totals.get(topic_id)
+            if total is None:
+                self.totals[topic_id] = [1, value, value, value, ts]
+            else:
+                total[0] += 1
+                total[1] += value
+                if value < total[2]:
+                    total[2] = value
+                if value > total[3]:
+                    total[3] = value
+                if ts > total[4]:
+                    total[4] = ts
+            touched.add(topic_id)
+        return touched
+
+    # topic -> (totals, {label: buckets in use}), the figures merge() folds
+    # into another TopicStats; smaller to send than the rings
+    def partial(self):
+        return {topic: (total, {label: [bucket for bucket in ring.buckets if bucket is not None]
+                                for label, ring in self.rings[topic].items()})
+                for topic, total in self.totals.items()}
+
+    # Folds in the partial() of another TopicStats, gathered from other rows
+    # and keyed by topic name (a worker of the sharded ingester); ids maps
+    # the names to topic ids. Returns the topic ids touched.
+    def merge(self, partial, ids):
+        for name, ((count, total, low, high, last_ts), buckets) in partial.items():
+            topic_id = ids[name]
+            current = self.totals.get(topic_id)
+            if current is None:
+                self.totals[topic_id] = [count, total, low, high, last_ts]
+            else:
+                current[0] += count
+                current[1] += total
+                current[2] = min(current[2], low)
+                current[3] = max(current[3], high)
+                current[4] = max(current[4], last_ts)
+            rings = self.rings_of(topic_id)
+            for label, ring_buckets in buckets.items():
+                for bucket in ring_buckets:
+                    rings[label].merge(bucket)
+        return {ids[name] for name in partial}
+
+    # Writes the rows of topic_ids (default: all topics) as of now
+    def store(self, conn, topic_ids=None, now=None):
+        now = int(time.time() * 1000) if now is None else now
+        rows = []
+        for topic_id in self.totals if topic_ids is None else topic_ids:
+            count, total, low, high, last_ts = self.totals[topic_id]
+            rows.append((topic_id, 'all', count, low, high, total / count, None, None, last_ts, now))
+            for label, ring in self.rings_of(topic_id).items():
+                rows.append((topic_id, label) + ring.summary(now) + (now,))
+        if rows:
+            conn.executemany('''
+                INSERT OR REPLACE INTO topic_stats (topic_id, span, count, min, max, mean, std, rate, last_ts, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+
+    # Picks up where the last run stopped: the totals from topic_stats,
+    # which is written in the same transaction as the rows, and the windows
+    # from the raw rows they cover
+    def restore(self, conn, now=None):
+        now = int(time.time() * 1000) if now is None else now
+        for topic_id, count, low, high, mean, last_ts in conn.execute(
+                "SELECT topic_id, count, min, max, mean, last_ts FROM topic_stats WHERE span = 'all' AND count > 0"):
+            self.totals[topic_id] = [count, mean * count, low, high, last_ts]
+        for label, length in self.windows.items():
+            width = max(1, length // BUCKETS)
+            start = (now // width - BUCKETS + 1) * width
+            end = (now // width + 1) * width
+            for topic_id, index, count, mean, sumsq, low, high, mean_ts, last_ts in conn.execute(f'''
+                    SELECT topic_id, ts / {width}, count(*), avg(value), sum(value * value), min(value), max(value), avg(ts), max(ts)
+                    FROM temp WHERE ts >= ? AND ts < ? AND value IS NOT NULL GROUP BY 1, 2
+                ''', (start, end)):
+                bucket = new_bucket(index)
+                bucket[COUNT:] = [count, mean, max(0.0, sumsq - count * mean * mean), low, high, mean_ts, last_ts]
+                self.rings_of(topic_id)[label].buckets[index % BUCKETS] = bucket
+
+
+# Rebuilds the 'all' rows from the 1-hour rollups, which keep every numeric
+# reading ever stored; the windows are filled in by the ingester
+def rebuild_totals(conn):
+    conn.execute("DELETE FROM topic_stats WHERE span = 'all'")
+    conn.execute(f'''
+        INSERT INTO topic_stats (topic_id, span, count, min, max, mean, std, rate, last_ts, updated)
+        SELECT r.topic_id, 'all', sum(r.count), min(r.min), max(r.max), sum(r.sum) / sum(r.count), NULL, NULL,
+               (SELECT ts FROM temp_latest WHERE temp_latest.topic_id = r.topic_id),
+               CAST(strftime('%s', 'now') AS INTEGER) * 1000
+        FROM temp_1h AS r GROUP BY r.topic_id
+    ''')
+
+
+# Adds (topic_id, count, sum, min, max, last_ts) of readings stored by
+# another writer (backfill.py) to the 'all' rows
+def add_totals(conn, totals):
+    conn.executemany('''
+        INSERT INTO topic_stats (topic_id, span, count, min, max, mean, std, rate, last_ts, updated)
+        VALUES (?1, 'all', ?2, ?4, ?5, ?3 / ?2, NULL, NULL, ?6, CAST(strftime('%s', 'now') AS INTEGER) * 1000)
+        ON CONFLICT (topic_id, span) DO UPDATE SET
+            count = count + excluded.count,
+            min = min(min, excluded.min),
+            max = max(max, excluded.max),
+            mean = (mean * count + ?3) / (count + excluded.count),
+            last_ts = max(last_ts, excluded.last_ts),
+            updated = excluded.updated
+    ''', totals)
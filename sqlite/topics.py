@@ -0,0 +1,16 @@
+# Topic names are stored once, in the topics table (see init.sql); the other
+# tables refer to them by id. The registry caches the ids the ingester has
+# seen, so a batch only touches the table for topics it has never seen before.
+class TopicRegistry:
+    def __init__(self):
+        self.ids = {}
+
+    # Returns the (topic, value, message, ts) rows as (topic_id, value,
+    # message, ts), registering new topics. Runs inside the batch's
+    # transaction, so a topic and its first rows are committed together.
+    def encode(self, conn, rows):
+        ids = self.ids
+        for name in {row[0] for row in rows if row[0] not in ids}:
+            conn.execute('INSERT OR IGNORE INTO topics (name) VALUES (?)', (name,))
+            ids[name] = conn.execute('SELECT id FROM topics WHERE name = ?', (name,)).fetchone()[0]
+        return [(ids[topic], value, message, ts) for topic, value, message, ts in rows]